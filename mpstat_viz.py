@@ -10,6 +10,7 @@ import argparse
 import common_plotting as complot
 import util
 import iperf_viz
+import sar_data_loading as sdl
 
 # Data mangling
 
@@ -53,43 +54,9 @@ def _stat_entry_timestamp(stat_entry_dict):
 
 
 def to_percpu_df(mpstat_json, norm_timestamps=True, filter_timerange=None):
-    n_cpus = mpstat_json["number-of-cpus"]
-    ts = get_timestamps(mpstat_json)
-    time_ref = None if filter_timerange is None else filter_timerange[0]
-
-    per_cpu = dict()
-    for period in mpstat_json["statistics"]:
-        for entry in period["cpu-load"]:
-            cpu = entry["cpu"]
-            mult = n_cpus if cpu == "all" else 1
-            if cpu not in per_cpu:
-                per_cpu[cpu] = dict()
-
-            for loadtype, load in entry.items():
-                if loadtype == "cpu":
-                    continue
-                if loadtype == "idle":
-                    loadtype = "total"
-                if loadtype not in per_cpu[cpu]:
-                    per_cpu[cpu][loadtype] = []
-
-                if loadtype == "total":
-                    per_cpu[cpu]["total"].append((100 - load) * mult)
-                else:
-                    per_cpu[cpu][loadtype].append(load * mult)
-
-    for cpu, data in per_cpu.items():
-        df = pd.DataFrame(data)
-        df.insert(0, "timestamp", ts)
-        if filter_timerange is not None:
-            df = df.loc[df["timestamp"].between(filter_timerange[0],
-                                                filter_timerange[1])]
-            df.reset_index(drop=True, inplace=True)
-        if norm_timestamps:
-            df["timestamp"] = util.normalize_timestamps(df["timestamp"], time_ref)
-        per_cpu[cpu] = df
-
-    return per_cpu
+    df = sdl.cpu_load_to_long_df(mpstat_json, get_timestamps(mpstat_json))
+    return sdl._long_df_to_pergroup(df, "cpu", filter_timerange,
+                                    norm_timestamps)
 
 
 def trim_only_under_load(per_cpu_dfs, load_thresh=1, neighbours=0, norm_timestamps="auto"):
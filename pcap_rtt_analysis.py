@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 import pandas as pd
 import scapy.all as scapy
+import sys
 
 import util
 import sar_data_loading as sdl
@@ -315,7 +316,7 @@ def _calculate_rtts_from_pcap(pcap_file, max_packets=None, verbose=False):
                     timestamp_rtt = float(packet.time - prev_pkt["time"])
                     break
 
-            rtts.append({"time": util.parse_unix_timestamp(str(packet.time)),
+            rtts.append({"time": str(packet.time),
                          "flow": flow,
                          "min_rtt": min_rtt,
                          "max_rtt": max_rtt,
@@ -329,7 +330,9 @@ def _calculate_rtts_from_pcap(pcap_file, max_packets=None, verbose=False):
 
     if len(rtts) == 0:
         return None
-    return pd.DataFrame.from_records(rtts)
+    rtts = pd.DataFrame.from_records(rtts)
+    rtts["time"] = util.parse_unix_timestamps(rtts["time"].values)
+    return rtts
 
 
 def find_unsync_tsval_update(pcap_file, **kwargs):
@@ -340,5 +343,19 @@ def find_too_fast_retrans(pcap_file, **kwargs):
     return sdl._run_on_xz_file(_find_too_fast_retrans, pcap_file, **kwargs)
 
 
-def calculate_rtts_from_pcap(pcap_file, **kwargs):
-    return sdl._run_on_xz_file(_calculate_rtts_from_pcap, pcap_file, **kwargs)
+def calculate_rtts_from_pcap(pcap_file, use_cache=True, **kwargs):
+    """
+    RTTs calculated by _calculate_rtts_from_pcap. Unless use_cache is False,
+    the result is cached in a util.ResultCache, keyed on the pcap, kwargs,
+    the source of this module and util, and the scapy version.
+    """
+    def compute():
+        return sdl._run_on_xz_file(_calculate_rtts_from_pcap, pcap_file,
+                                   **kwargs)
+
+    if not use_cache:
+        return compute()
+    source = util.source_hash(sys.modules[__name__], util)
+    return util.ResultCache().get("calculate_rtts_from_pcap", pcap_file,
+                                  compute, kwargs=kwargs, source=source,
+                                  scapy=scapy.conf.version)
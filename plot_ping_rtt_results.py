@@ -12,6 +12,7 @@ import argparse
 
 import util
 import common_plotting as complot
+import pping_ping_accuracy_viz as ppa_viz
 
 
 def parse_epping_rtts(filename):
@@ -59,45 +60,7 @@ def is_epping_ppviz_rtt_line(line):
 
 
 def parse_ping_rtts(filename):
-    data = list()
-
-    with util.open_compressed_file(filename, mode="rt") as infile:
-        for line in infile:
-            parsed_info = parse_ping_rtt_line(line.rstrip())
-
-            if parsed_info is not None:
-                data.append(parsed_info)
-
-    return pd.DataFrame(data)
-
-def parse_ping_rtt_line(line):
-    if not is_ping_rtt_line(line):
-        return None
-
-    words = line.split()
-    if words[0].startswith("[") and words[0].endswith("]"):
-        time = pd.to_datetime(words[0][1:-1], unit="s")
-        offset = 1
-    else:
-        time = None
-        offset = 0
-
-    dst = words[3 + offset][:-1]
-    seq = int(words[4 + offset].split("=")[1])
-
-    rtt_str = words[-2].split("=")[1]
-    rtt = float(words[-2].split("=")[1]) / 1000
-    n_dec = len(rtt_str) - rtt_str.find(".") - 1 if rtt_str.find(".") >= 0 else 0
-    rtt_prec = 10**(-3 - n_dec)
-
-    return {"timestamp": time, "rtt": rtt, "rtt_prec": rtt_prec, "dst": dst,
-            "seq": seq}
-
-
-def is_ping_rtt_line(line):
-    return re.match(
-        "^(\[\d+\.\d+\] )?\d+ bytes from [\d\.:]+: icmp_seq=\d+ .* time=\d+(\.\d+)? ms$",
-        line) is not None
+    return ppa_viz.parse_ping_rtts(filename)
 
 
 def read_rtt_data(data_folder):
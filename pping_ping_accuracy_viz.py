@@ -10,6 +10,8 @@ import sys
 import re
 import argparse
 import os
+import collections
+import itertools
 
 import util
 import common_plotting as complot
@@ -17,17 +19,319 @@ import common_plotting as complot
 unit_conversion = {"s": 1.0, "ms": 1e3, "us": 1e6, "ns": 1e9}
 
 
-def parse_epping_rtts(filename):
-    data = list()
-
-    with util.open_compressed_file(filename, mode="rt") as infile:
-        for line in infile:
-            parsed_info = parse_epping_rtt_line(line.rstrip())
-
-            if parsed_info is not None:
-                data.append(parsed_info)
+# Patterns for the parts of ePPing RTT lines in the standard and ppviz
+# formats, with groups for the timestamp and rtt, and the flow
+_epping_ts_rtt_patterns = {
+    "standard": r"(\d{2}:\d{2}:\d{2}\.\d+) (\d+\.\d+) ms ",
+    "ppviz": r"(\d+\.\d+) (\d+\.\d+) ",
+}
+_epping_flow_pattern = r"([\d\.:]+\+[\d\.:]+)[^\S\n]*$"
+
+# Patterns for ePPing RTT lines, with groups for the timestamp, rtt, the
+# words in between and the flow
+_epping_rtt_patterns = {
+    line_format: re.compile("^" + ts_rtt + "(.*) " + _epping_flow_pattern,
+                            re.MULTILINE)
+    for line_format, ts_rtt in _epping_ts_rtt_patterns.items()}
+
+
+def parse_epping_rtts(filename, chunk_lines=1 << 16, schema_lines=1000):
+    """
+    Parse the RTTs from an ePPing output file into a DataFrame. The lines are
+    parsed in chunks of chunk_lines lines. The format (standard or ppviz)
+    is determined from the first RTT line in the file, and the key=value
+    extras from the first schema_lines RTT lines (see infer_epping_schema).
+    """
+    with util.open_lines(filename) as infile:
+        return parse_epping_rtt_stream(infile, chunk_lines, schema_lines)
+
+
+def parse_epping_rtt_stream(infile, chunk_lines=1 << 16, schema_lines=1000):
+    """
+    Parse the RTTs from an open (text) file of ePPing output, such as the
+    stdout of a running process, like parse_epping_rtts. Only one chunk of
+    lines is held as text at a time, as each chunk is converted to typed
+    columns before reading the next.
+    """
+    schema = None
+    flows = dict()
+    chunks = list()
+
+    for text in util.iter_text_chunks(infile, chunk_lines):
+        if schema is None:
+            schema = infer_epping_schema(text, schema_lines)
+            if schema is None:
+                continue
+        chunks.append(_epping_fields_to_columns(
+            _extract_epping_rtt_fields(text, schema), schema, flows))
+
+    return _epping_columns_to_df(chunks, schema, flows)
+
+
+def sniff_epping_format(text):
+    """
+    Format ("standard" or "ppviz") of the first ePPing RTT line in text, or
+    None if there is no RTT line.
+    """
+    first_match = dict()
+    for line_format, pattern in _epping_rtt_patterns.items():
+        match = pattern.search(text)
+        if match is not None:
+            first_match[line_format] = match.start()
+    if len(first_match) < 1:
+        return None
+    return min(first_match, key=first_match.get)
+
+
+def infer_epping_schema(text, n_lines=1000):
+    """
+    Infer the format and the key=value extras of the ePPing RTT lines in
+    text from the first n_lines of them. The schema is the most common
+    sequence of keys (with values without "=") ending the words between
+    the rtt and the flow, and if their values all are integers. Returns
+    None if there are no RTT lines in text.
+    """
+    line_format = sniff_epping_format(text)
+    if line_format is None:
+        return None
 
-    return pd.DataFrame(data)
+    layouts = collections.Counter()
+    int_vals = dict()
+    for match in itertools.islice(
+            _epping_rtt_patterns[line_format].finditer(text), n_lines):
+        words = match.group(3).split()
+        n_kv = len(words)
+        while n_kv > 0 and words[n_kv - 1].count("=") == 1:
+            n_kv -= 1
+        if any("=" in word for word in words[:n_kv]):
+            continue
+
+        kvs = [word.split("=") for word in words[n_kv:]]
+        keys = tuple(key for key, _ in kvs)
+        layouts[keys] += 1
+        is_int = [re.fullmatch("-?[0-9]{1,18}", val) is not None for _, val in kvs]
+        int_vals[keys] = [a and b for a, b in zip(int_vals.get(keys, is_int), is_int)]
+
+    keys = layouts.most_common(1)[0][0] if len(layouts) > 0 else tuple()
+    if len(set(keys)) < len(keys):
+        keys = tuple()
+    return _epping_schema(line_format, keys, int_vals.get(keys, []))
+
+
+def _epping_schema(line_format, keys, int_keys):
+    """
+    Schema for lines in line_format with the key=value extras keys (the
+    values of keys where int_keys is True are expected to be integers).
+    After the timestamp and rtt, the pattern matches the rest of lines
+    following the schema, and otherwise the rest of the general pattern.
+    """
+    pattern = _epping_rtt_patterns[line_format].pattern
+    if len(keys) > 0:
+        kvs = " ".join(re.escape(key) + "=" + ("(-?[0-9]{1,18})" if is_int else r"([^\s=]*)")
+                       for key, is_int in zip(keys, int_keys))
+        pattern = "^{}(?:(?:[^=\n]* )?{} {}|(.*) {})".format(
+            _epping_ts_rtt_patterns[line_format], kvs, _epping_flow_pattern,
+            _epping_flow_pattern)
+
+    return {"format": line_format, "keys": keys, "int_keys": int_keys,
+            "pattern": re.compile(pattern, re.MULTILINE)}
+
+
+def _extract_epping_rtt_fields(text, schema):
+    """
+    The (string) timestamp, rtt and flow, the values of the schema keys and
+    the words in between for the lines not following the schema from all
+    RTT lines in text.
+    """
+    n_keys = len(schema["keys"])
+    n_groups = schema["pattern"].groups
+    matches = schema["pattern"].findall(text)
+    if len(matches) < 1:
+        groups = [np.array([], dtype=object)] * n_groups
+    else:
+        groups = [np.array(group, dtype=object) for group in zip(*matches)]
+
+    fields = {"timestamp": groups[0], "rtt": groups[1]}
+    if n_keys == 0:
+        fields.update({"flow": groups[3], "extra": groups[2],
+                       "schema_match": np.zeros(len(groups[0]), dtype=bool)})
+        return fields
+
+    # Groups: timestamp, rtt, keys, flow (schema) and extra, flow (general)
+    schema_match = groups[n_keys + 2] != ""
+    fields.update({"flow": np.where(schema_match, groups[n_keys + 2], groups[n_keys + 4]),
+                   "extra": groups[n_keys + 3], "schema_match": schema_match})
+    for i, key in enumerate(schema["keys"]):
+        fields["key:" + key] = groups[2 + i]
+
+    return fields
+
+
+def _epping_fields_to_columns(fields, schema, flows):
+    """
+    Convert the (string) fields of a chunk of RTT lines to typed columns:
+    the parsed timestamps (ppviz format), the rtts in s, the flows as codes
+    into flows (a dict of flow: code shared by all chunks) and the rows and
+    parsed values of each of the key=value extras.
+    """
+    if schema["format"] == "standard":
+        timestamps = fields["timestamp"]
+        rtts = fields["rtt"].astype(float) / 1000
+    else:
+        timestamps = util.parse_unix_timestamps(fields["timestamp"].astype(str))
+        rtts = fields["rtt"].astype(float)
+
+    codes, uniques = pd.factorize(fields["flow"])
+    flow_codes = np.array([flows.setdefault(flow, len(flows))
+                           for flow in uniques], dtype=np.int64)
+
+    extras = {arg: (rows, *_parse_numeric_values(vals, n_int))
+              for arg, (rows, vals, n_int)
+              in _epping_extra_values(fields, schema).items()}
+
+    return {"timestamp": timestamps, "rtt": rtts,
+            "flow": flow_codes[codes], "extras": extras}
+
+
+def _epping_columns_to_df(chunks, schema, flows):
+    n_rows = sum(len(chunk["rtt"]) for chunk in chunks)
+    if n_rows < 1:
+        return pd.DataFrame()
+
+    timestamps = np.concatenate([chunk["timestamp"] for chunk in chunks])
+    if schema["format"] == "standard":
+        timestamps = timestamps.astype(object)
+    flow_names = np.array(list(flows.keys()), dtype=object)
+    df = pd.DataFrame({"timestamp": timestamps,
+                       "rtt": np.concatenate([chunk["rtt"] for chunk in chunks]),
+                       "flow": flow_names[np.concatenate([chunk["flow"]
+                                                          for chunk in chunks])]})
+
+    # Extras in order of first appearance in the whole file
+    extras = dict()
+    offset = 0
+    for chunk in chunks:
+        for arg, (rows, vals, short) in chunk["extras"].items():
+            extras.setdefault(arg, []).append((rows + offset, vals, short))
+        offset += len(chunk["rtt"])
+    for arg, parts in extras.items():
+        df[arg] = _numeric_column(parts, n_rows)
+
+    return df
+
+
+def _epping_extra_values(fields, schema):
+    """
+    The rows and (string) values of each of the key=value extras, combining
+    the values extracted for the lines following the schema with the ones
+    parsed by parse_extra_epping_args for the other lines, and how many of
+    the first values are known to be valid int64 integers. Extras are in
+    order of first appearance, like when creating a DataFrame from per-line
+    dicts.
+    """
+    schema_rows = np.flatnonzero(fields["schema_match"])
+    other_args = _parse_extra_epping_args_rows(fields["extra"],
+                                               np.flatnonzero(~fields["schema_match"]))
+
+    first_seen = dict()
+    for i, key in enumerate(schema["keys"]):
+        if len(schema_rows) > 0:
+            first_seen[key] = (schema_rows[0], i)
+    for i, (arg, row_vals) in enumerate(other_args.items()):
+        first_row = next(iter(row_vals))
+        if arg not in first_seen or first_row < first_seen[arg][0]:
+            first_seen[arg] = (first_row, i)
+
+    extras = dict()
+    for arg in sorted(first_seen, key=first_seen.get):
+        row_vals = other_args.get(arg, dict())
+        rows = np.fromiter(row_vals.keys(), dtype=np.int64, count=len(row_vals))
+        vals = np.array(list(row_vals.values()), dtype=object)
+        n_int = 0
+        if arg in schema["keys"] and len(schema_rows) > 0:
+            i = schema["keys"].index(arg)
+            if schema["int_keys"][i]:
+                n_int = len(schema_rows)
+            rows = np.concatenate([schema_rows, rows])
+            vals = np.concatenate([fields["key:" + arg][schema_rows], vals])
+        extras[arg] = (rows, vals, n_int)
+
+    return extras
+
+
+def _parse_extra_epping_args_rows(extras, rows):
+    """
+    parse_extra_epping_args for the (joined) words of the given rows,
+    giving a dict of row: value (str) for each key.
+    """
+    args = dict()
+    for row in rows:
+        extra = extras[row]
+        if "=" not in extra:
+            continue
+        for word in extra.split():
+            if "=" in word:
+                arg, val = word.split("=")
+                if arg not in args:
+                    args[arg] = dict()
+                args[arg][row] = val
+
+    return args
+
+
+def _parse_numeric_values(vals, n_int=0):
+    """
+    Parse the string vals like util.try_parse_numeric, into an int64 array
+    if they all are integers, a float array if they all are non-integer
+    numbers, and otherwise an object array. Also gives whether all vals are
+    short enough (<= 18 characters) to not lose the precision of large ints
+    as floats. The first n_int vals are already known to be valid int64
+    integers.
+    """
+    short = len(vals) < 1 or max(len(val) for val in vals) <= 18
+    try:
+        return np.concatenate([vals[:n_int].astype(np.int64),
+                               np.array([int(val) for val in vals[n_int:]],
+                                        dtype=np.int64)]), short
+    except (ValueError, OverflowError):
+        pass
+
+    vals = [util.try_parse_numeric(val, fallback="str") for val in vals]
+    if all(type(val) is float for val in vals):
+        return np.array(vals, dtype=float), short
+    return np.array(vals, dtype=object), short
+
+
+def _numeric_column(parts, n_rows):
+    """
+    Column of n_rows from the (rows, vals, short) parsed for parts of it
+    by _parse_numeric_values (other rows are missing), with the column
+    type inferred like pandas does.
+    """
+    rows = np.concatenate([part_rows for part_rows, _, _ in parts])
+
+    if all(vals.dtype == np.int64 for _, vals, _ in parts):
+        if len(rows) == n_rows:
+            col = np.empty(n_rows, dtype=np.int64)
+        else:
+            col = np.full(n_rows, np.nan)
+        col[rows] = np.concatenate([vals for _, vals, _ in parts])
+        return col
+
+    # A mix of ints and floats becomes a float column (if the ints are not
+    # so large that they cannot be represented by int64)
+    if all(short and (vals.dtype != object or
+                      all(type(val) in (int, float) for val in vals))
+           for _, vals, short in parts):
+        col = np.full(n_rows, np.nan)
+        col[rows] = np.concatenate([vals.astype(float) for _, vals, _ in parts])
+        return col
+
+    col = [np.nan] * n_rows
+    vals = np.concatenate([vals.astype(object) for _, vals, _ in parts])
+    for row, val in zip(rows, vals):
+        col[row] = val
+    return pd.DataFrame({"col": col})["col"].values
 
 
 def parse_epping_rtt_line(line):
@@ -62,17 +366,51 @@ def is_epping_ppviz_rtt_line(line):
         line) is not None
 
 
-def parse_ping_rtts(filename):
-    data = list()
+# Pattern for ping RTT lines, with groups for the (optional) timestamp, dst,
+# seq, rtt and the decimals of the rtt
+_ping_rtt_pattern = re.compile(
+    r"^(?:\[(\d+\.\d+)\] )?\d+ bytes from ([\d\.:]+): icmp_seq=(\d+) .* "
+    r"time=(\d+(?:\.(\d+))?) ms[^\S\n]*$", re.MULTILINE)
+
+
+def parse_ping_rtts(filename, chunk_lines=1 << 16):
+    """
+    Parse the RTTs from ping output into a DataFrame. The lines are parsed
+    in chunks of chunk_lines lines, giving the same result as
+    parse_ping_rtt_line for each line.
+    """
+    chunks = list()
 
-    with util.open_compressed_file(filename, mode="rt") as infile:
-        for line in infile:
-            parsed_info = parse_ping_rtt_line(line.rstrip())
+    with util.open_lines(filename) as infile:
+        for text in util.iter_text_chunks(infile, chunk_lines):
+            matches = _ping_rtt_pattern.findall(text)
+            if len(matches) > 0:
+                chunks.append([np.array(group, dtype=object)
+                               for group in zip(*matches)])
 
-            if parsed_info is not None:
-                data.append(parsed_info)
+    if len(chunks) < 1:
+        return pd.DataFrame()
 
-    return pd.DataFrame(data)
+    timestamps, dsts, seqs, rtts, decimals = (
+        np.concatenate(group) for group in zip(*chunks))
+
+    # Lines without timestamp get None (or NaT if other lines have one)
+    has_ts = timestamps != ""
+    if not np.any(has_ts):
+        timestamps = np.full(len(has_ts), None, dtype=object)
+    else:
+        parsed_ts = pd.to_datetime(timestamps[has_ts], unit="s").values
+        timestamps = np.full(len(has_ts), np.datetime64("NaT"), dtype=parsed_ts.dtype)
+        timestamps[has_ts] = parsed_ts
+
+    n_decimals = np.fromiter(map(len, decimals), dtype=np.int64, count=len(decimals))
+    precisions = np.array([10**(-3 - n_dec) for n_dec in range(n_decimals.max() + 1)])
+
+    return pd.DataFrame({"timestamp": timestamps,
+                         "rtt": rtts.astype(float) / 1000,
+                         "rtt_prec": precisions[n_decimals],
+                         "dst": dsts,
+                         "seq": seqs.astype(np.int64)})
 
 
 def parse_extra_epping_args(words):
@@ -1,91 +1,125 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
+import numpy as np
 import pandas as pd
 import os
 import subprocess
 import re
 import sys
-from io import StringIO
+import functools
+import contextlib
+import concurrent.futures
+import tempfile
+import struct
+import array
+import mmap
 
 import util
 import pping_ping_accuracy_viz as ppa_viz
 import sar_data_loading as sdl
+import tcp_rtt_analysis as tra
 
 
-def _parse_kpping_rtts(pcap, pping_path="~/src/pping/pping"):
-    p = subprocess.run([os.path.expanduser(pping_path), "-r", pcap, "-m"],
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if p.returncode != 0:
-        raise ChildProcessError("pping failed parsing {}: {}".format(pcap, p.stderr))
+def _parse_kpping_rtts(pcap, pping_path="~/src/pping/pping", flow=None):
+    cmd = [os.path.expanduser(pping_path), "-m"]
+    if flow is not None:
+        cmd += ["-f", _flow_filters(flow)[1]]
+    cmd += ["-r"]
 
-    data = list()
-    for line in p.stdout.split("\n"):
-        parsed_info = ppa_viz.parse_epping_rtt_line(line)
-        if parsed_info is not None:
-            data.append(parsed_info)
-
-    return pd.DataFrame(data)
+    # Parse the output while pping is still running
+    with util.PipedFile(cmd, pcap, mode="rt") as infile:
+        return ppa_viz.parse_epping_rtt_stream(infile)
 
 
 def parse_kpping_rtts(pcap, pping_path="~/src/pping/pping"):
     return sdl._run_on_xz_file(_parse_kpping_rtts, pcap, pping_path=pping_path)
 
 
-def _get_tshark_rtts(pcap):
-    p = subprocess.run(["tshark", "-r", pcap, "-Y", "tcp.analysis.ack_rtt",
-                        "-e", "frame.time_epoch",
-                        "-e", "ip.src",
-                        "-e", "tcp.srcport",
-                        "-e", "ip.dst",
-                        "-e", "tcp.dstport",
-                        "-e", "tcp.analysis.ack_rtt",
-                        "-e", "tcp.options.timestamp.tsecr",
-                        "-e", "tcp.options.timestamp.tsval",
-                        "-e", "tcp.ack_raw",
-                        "-T", "fields", "-E", "separator=,", "-E", "header=y"],
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if p.returncode != 0:
-        raise ChildProcessError("tshark failed in file {}: {}".format(pcap, p.stderr))
-
-    data = pd.read_csv(StringIO(p.stdout), dtype={"frame.time_epoch": "str"})
-    data = data.rename(columns={"frame.time_epoch": "timestamp",
-                                "tcp.analysis.ack_rtt": "rtt",
-                                "tcp.options.timestamp.tsval": "tsval",
-                                "tcp.options.timestamp.tsecr": "tsecr",
-                                "tcp.ack_raw": "ack"})
-
-    data["timestamp"] = [util.parse_unix_timestamp(tstr)
-                         for tstr in data["timestamp"]]
-
-    col_idx = {col: i for i, col in enumerate(data.columns)}
-    data["flow"] = ["{}:{}+{}:{}".format(row[col_idx["ip.src"]],
-                                         row[col_idx["tcp.srcport"]],
-                                         row[col_idx["ip.dst"]],
-                                         row[col_idx["tcp.dstport"]])
-                    for row in data.itertuples(index=False)]
-
-    return data
+_tshark_fields = {"frame.time_epoch": "timestamp",
+                  "ip.src": "ip.src",
+                  "tcp.srcport": "tcp.srcport",
+                  "ip.dst": "ip.dst",
+                  "tcp.dstport": "tcp.dstport",
+                  "tcp.analysis.ack_rtt": "rtt",
+                  "tcp.options.timestamp.tsecr": "tsecr",
+                  "tcp.options.timestamp.tsval": "tsval",
+                  "tcp.ack_raw": "ack"}
+_tshark_flow_fields = ["ip.src", "tcp.srcport", "ip.dst", "tcp.dstport"]
+
+
+def _format_tshark_chunk(chunk):
+    """
+    Parse the timestamps of a chunk of tshark output and build the flow
+    labels from the raw address and port fields (read as strings).
+    """
+    chunk = chunk.rename(columns=_tshark_fields)
+    chunk["timestamp"] = util.parse_unix_timestamps(chunk["timestamp"].values)
+
+    addr = [chunk[col].fillna("nan") for col in _tshark_flow_fields]
+    chunk["flow"] = (addr[0] + ":" + addr[1] + "+" +
+                     addr[2] + ":" + addr[3])
+    for col in ("tcp.srcport", "tcp.dstport"):
+        chunk[col] = pd.to_numeric(chunk[col])
+
+    return chunk
+
+
+def _get_tshark_rtts(pcap, flow=None, chunksize=1 << 18):
+    display_filter = ("tcp.analysis.ack_rtt" if flow is None
+                      else _flow_filters(flow)[0])
+    cmd = ["tshark", "-Y", display_filter]
+    for field in _tshark_fields.keys():
+        cmd += ["-e", field]
+    cmd += ["-T", "fields", "-E", "separator=,", "-E", "header=y", "-r"]
+
+    # Stream the output in chunks instead of holding all of it as a string
+    chunks = list()
+    with util.PipedFile(cmd, pcap) as infile:
+        try:
+            reader = pd.read_csv(infile, chunksize=chunksize,
+                                 dtype={field: str for field in
+                                        ["frame.time_epoch"] +
+                                        _tshark_flow_fields})
+            for chunk in reader:
+                chunks.append(_format_tshark_chunk(chunk))
+        except pd.errors.EmptyDataError:
+            pass
+
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=list(_tshark_fields.values()) + ["flow"])
+    return pd.concat(chunks, ignore_index=True)
 
 
 def get_tshark_rtts(pcap):
     return sdl._run_on_xz_file(_get_tshark_rtts, pcap)
 
 
-def _get_tcptrace_rtts(pcap):
-    p = subprocess.run([os.path.expanduser("~/src/tcptrace/tcptrace"), "-Z", "-b", pcap], 
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if p.returncode != 0:
-        raise ChildProcessError("tcptrace failed on file {}: {}".format(pcap, p.stderr))
+_tcptrace_path = "~/src/tcptrace/tcptrace"
+
+
+def _read_tcptrace_rttraw(rtt_file, flow):
+    rtts = pd.read_csv(rtt_file, sep=" ", header=None, names=["firstbyte", "rtt"])
+    rtts["rtt"] = rtts["rtt"] * 1e-6
+    rtts["flow"] = flow
+    return rtts
 
-    dfs = list()
-    flow_mapping = parse_tcptrace_flow_mapping(p.stdout)
 
-    for flow_abr, flow in flow_mapping.items():
-        rtt_file = flow_abr + "_rttraw.dat"
-        rtts = pd.read_csv(rtt_file, sep=" ", header=None, names=["firstbyte", "rtt"])
-        rtts["rtt"] = rtts["rtt"] * 1e-6
-        rtts["flow"] = flow
-        os.remove(rtt_file)
-        dfs.append(rtts)
+def _get_tcptrace_rtts(pcap, max_workers=None):
+    # tcptrace writes the rttraw files to the working directory, so run it in
+    # a private one to not collide with other runs
+    with tempfile.TemporaryDirectory(prefix="tcptrace_") as tmpdir:
+        p = subprocess.run([os.path.expanduser(_tcptrace_path),
+                            "-Z", "-b", os.path.abspath(pcap)], cwd=tmpdir,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           text=True)
+        if p.returncode != 0:
+            raise ChildProcessError("tcptrace failed on file {}: {}".format(pcap, p.stderr))
+
+        flow_mapping = parse_tcptrace_flow_mapping(p.stdout)
+        rtt_files = [os.path.join(tmpdir, flow_abr + "_rttraw.dat")
+                     for flow_abr in flow_mapping.keys()]
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            dfs = list(executor.map(_read_tcptrace_rttraw, rtt_files,
+                                    flow_mapping.values()))
 
     return pd.concat(dfs, ignore_index=True)
 
@@ -120,19 +154,137 @@ def parse_tcptrace_flow_mapping_line(line):
 
 
 def get_main_flow(flows, srcip="10.70.2.2"):
-    flow_count = dict()
-    for flow in flows:
-        if flow.startswith(srcip):
-            flow_count[flow] = flow_count.get(flow, 0) + 1
+    """
+    The flow starting with srcip that occurs most often in flows (the first
+    one to appear in case of ties), or None if there is no such flow.
+    """
+    flows = pd.Series(flows, dtype=object)
+    flows = flows.values[flows.str.startswith(srcip, na=False).values]
+    if len(flows) == 0:
+        return None
 
-    max_f = None
-    max_c = -1
-    for flow, count in flow_count.items():
-        if count > max_c:
-            max_c = count
-            max_f = flow
+    codes, uniques = pd.factorize(flows)
+    return uniques[np.argmax(np.bincount(codes))]
+
+
+def _flow_filters(flow):
+    """
+    tshark display filter (for the RTT samples of flow) and pcap filter (for
+    both directions of flow) selecting a flow label of the form
+    srcip:srcport+dstip:dstport.
+    """
+    src, dst = flow.split("+")
+    srcip, srcport = src.rsplit(":", 1)
+    dstip, dstport = dst.rsplit(":", 1)
+
+    display_filter = ("tcp.analysis.ack_rtt && ip.src=={} && tcp.srcport=={} "
+                      "&& ip.dst=={} && tcp.dstport=={}".format(
+                          srcip, srcport, dstip, dstport))
+    pcap_filter = "host {} and host {} and tcp port {} and tcp port {}".format(
+        srcip, dstip, srcport, dstport)
+    return display_filter, pcap_filter
+
+
+# Byte order of the (classic) pcap formats with us and ns timestamps
+_pcap_magics = {b"\xd4\xc3\xb2\xa1": "<", b"\x4d\x3c\xb2\xa1": "<",
+                b"\xa1\xb2\xc3\xd4": ">", b"\xa1\xb2\x3c\x4d": ">"}
+# Offset of the IP header for Ethernet and Linux cooked captures, which
+# both have the ethertype in the two bytes before it
+_pcap_link_offsets = {1: 14, 113: 16}
+
+
+def _uint_from_bytes(data, idx, n_bytes):
+    """Big-endian unsigned ints of n_bytes starting at each index in idx"""
+    val = np.zeros(len(idx), dtype=np.uint64)
+    for i in range(n_bytes):
+        val = (val << np.uint64(8)) | data[idx + i]
+    return val
+
+
+def _pcap_packet_headers(pcap):
+    """
+    Source and destination IPs and ports of each IPv4 TCP packet in a pcap
+    file, only reading the record and packet headers. Returns None for
+    pcapng files and unsupported link types.
+    """
+    with open(pcap, "rb") as infile:
+        header = infile.read(24)
+        if len(header) < 24 or header[:4] not in _pcap_magics:
+            return None
+        endian = _pcap_magics[header[:4]]
+        linktype = struct.unpack(endian + "I", header[20:24])[0] & 0xffff
+        if linktype not in _pcap_link_offsets:
+            return None
+        link_off = _pcap_link_offsets[linktype]
+
+        if os.fstat(infile.fileno()).st_size <= 24:
+            return pd.DataFrame({col: np.array([], dtype=np.uint64) for col in
+                                 ("src", "sport", "dst", "dport")})
+
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            # Records have variable length, so walk the record headers (doing
+            # as little as possible per record) and get the rest in bulk
+            unpack_caplen = struct.Struct(endian + "I").unpack_from
+            offsets = array.array("q")
+            append = offsets.append
+            off = 24
+            end = len(buf) - 16
+            while off <= end:
+                append(off)
+                off += 16 + unpack_caplen(buf, off + 8)[0]
+
+            data = np.frombuffer(buf, dtype=np.uint8)
+            offsets = np.frombuffer(offsets, dtype=np.int64)
+            caplens = data[(offsets + 8)[:, None] + np.arange(4)].view(
+                endian + "u4").ravel().astype(np.int64)
+
+            # Keep complete IPv4 packets (with room for the IP header)
+            keep = offsets + 16 + caplens <= len(data)
+            keep &= caplens >= link_off + 20
+            ip = offsets[keep] + 16 + link_off
+            caplens = caplens[keep]
+            keep = ((data[ip - 2] == 0x08) & (data[ip - 1] == 0x00) &
+                    (data[ip] >> 4 == 4) & (data[ip + 9] == 6))
+            ip, caplens = ip[keep], caplens[keep]
+
+            # ...that are TCP with the ports captured
+            tcp = ip + (data[ip] & 0x0f).astype(np.int64) * 4
+            keep = tcp + 4 <= ip - link_off + caplens
+            ip, tcp = ip[keep], tcp[keep]
+
+            headers = pd.DataFrame({"src": _uint_from_bytes(data, ip + 12, 4),
+                                    "sport": _uint_from_bytes(data, tcp, 2),
+                                    "dst": _uint_from_bytes(data, ip + 16, 4),
+                                    "dport": _uint_from_bytes(data, tcp + 2, 2)})
+            del data
+    return headers
+
+
+def _ipv4_to_str(addr):
+    return ".".join(str((int(addr) >> shift) & 0xff) for shift in (24, 16, 8, 0))
+
+
+def get_pcap_main_flow(pcap, srcip="10.70.2.2"):
+    """
+    Find the main flow (see get_main_flow) of a pcap file from the number
+    of packets per flow, by a cheap scan of the packet headers instead of
+    running any of the tools. Returns None if the pcap could not be
+    scanned (ex. if it is a pcapng file).
+    """
+    headers = _pcap_packet_headers(pcap)
+    if headers is None:
+        return None
 
-    return max_f
+    # Groups are in order of first appearance, so argmax breaks ties the
+    # same way as get_main_flow
+    counts = headers.groupby(["src", "sport", "dst", "dport"], sort=False).size()
+    flows = pd.Series(["{}:{}+{}:{}".format(_ipv4_to_str(src), sport,
+                                            _ipv4_to_str(dst), dport)
+                       for src, sport, dst, dport in counts.index], dtype=object)
+    from_src = flows.str.startswith(srcip).values
+    if not from_src.any():
+        return None
+    return flows.values[from_src][np.argmax(counts.values[from_src])]
 
 
 def parse_tcpdump_info(info_file):
@@ -162,14 +314,28 @@ def get_pcap_file(subfolder):
         os.path.join(subfolder, "e_pping", "M2"), "packetdump.pcap")
 
 
+def get_netem_schedule_file(subfolder):
+    return ppa_viz.get_file_with_unknown_suffix(
+        os.path.join(subfolder, "e_pping"), "netem_schedule.log")
+
+
 def get_tcpdump_info_file(subfolder):
     return ppa_viz.get_file_with_unknown_suffix(
         os.path.join(subfolder, "e_pping", "M2"), "tcpdump_info.txt")
 
 
-def _filter_and_format_data(df, srcip="10.70.2.2", delay=None):
-    df = df.loc[df["flow"] == get_main_flow(df["flow"],
-                                            srcip=srcip)].reset_index(drop=True)
+def _run_on_main_flow(func, pcap, main_flow):
+    """
+    Run func on pcap, limited to the flow that the main_flow future resolves
+    to.
+    """
+    return func(pcap, flow=main_flow.result())
+
+
+def _filter_and_format_data(df, srcip="10.70.2.2", delay=None, flow=None):
+    if flow is None:
+        flow = get_main_flow(df["flow"], srcip=srcip)
+    df = df.loc[df["flow"] == flow].reset_index(drop=True)
 
     df["rtt_ms"] = df["rtt"] * 1e3
     df["rtt_us"] = df["rtt"] * 1e6
@@ -184,30 +350,137 @@ def _filter_and_format_data(df, srcip="10.70.2.2", delay=None):
 def load_all_rtt_data(root_folder, srcip="10.70.2.2",
                       pping_path="~/src/pping/pping",
                       tools=["tshark", "tcptrace", "PPing", "ePPing"],
-                      normalize_timestamps=True):
-    data = dict()
-
+                      normalize_timestamps=True, use_cache=True):
+    """
+    Load the RTTs of the main flow reported by each of the tools. If the
+    test logged a netem schedule, the base_delay of the RTTs with absolute
+    timestamps is set from it (see tcp_rtt_analysis.add_delay_offset). Unless
+    use_cache is False, the output of the tools run on the pcap is cached in
+    a util.ResultCache, keyed on the pcap, tool, srcip and the source of the
+    modules parsing the output. The main flow is taken from the pcap (see
+    get_pcap_main_flow) for all tools, with a warning for the tools that
+    see a different main flow.
+    """
     dump_info = parse_tcpdump_info(get_tcpdump_info_file(root_folder))
     if dump_info["dropped"] > 0:
         print("Warning: tcpdump dropped packets in {}".format(
             get_tcpdump_info_file(root_folder)), file=sys.stderr)
 
-    pcap = get_pcap_file(root_folder)
-    if "tshark" in tools:
-        data["tshark"] = _filter_and_format_data(get_tshark_rtts(pcap),
-                                                 srcip=srcip)
-    if "tcptrace" in tools:
-        data["tcptrace"] = _filter_and_format_data(get_tcptrace_rtts(pcap),
+    # The tools that can be limited to the main flow (found by scanning the
+    # pcap) are given it as a filter, which makes them output much less
+    pcap_tools = {"tshark": (_get_tshark_rtts, "tshark", True),
+                  "tcptrace": (_get_tcptrace_rtts, _tcptrace_path, False),
+                  "PPing": (functools.partial(_parse_kpping_rtts,
+                                              pping_path=pping_path),
+                            pping_path, True)}
+    pcap_tools = {tool: entry for tool, entry in pcap_tools.items()
+                  if tool in tools}
+
+    cache_entries = dict()
+    if use_cache and len(pcap_tools) > 0:
+        cache = util.ResultCache()
+        source = util.source_hash(sys.modules[__name__], util, ppa_viz)
+        cache_entries["main_flow"] = cache.entry_path(
+            "pta_viz-main_flow", get_pcap_file(root_folder), source=source,
+            srcip=srcip)
+        for tool, (_, program, main_flow_filter) in pcap_tools.items():
+            params = {"srcip": srcip} if main_flow_filter else dict()
+            cache_entries[tool] = cache.entry_path(
+                "pta_viz-" + tool, get_pcap_file(root_folder),
+                program=util.program_identity(program), source=source,
+                **params)
+    cached = {key for key, path in cache_entries.items()
+              if os.path.exists(path)}
+
+    # Run the tools concurrently on a single decompressed copy of the pcap,
+    # while parsing the ePPing output. The scan for the main flow runs in
+    # the executor as well, so only the tools filtering on it wait for it.
+    results = dict()
+    raw_results = dict()
+    with contextlib.ExitStack() as stack:
+        if len(pcap_tools) > 0 and len(cached) < len(pcap_tools) + 1:
+            pcap = stack.enter_context(util.decompressed_file(
+                get_pcap_file(root_folder)))
+        executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(pcap_tools) + 2))
+
+        # Submitted first, so that it gets a worker before the tools that
+        # block on it
+        main_flow_future = None
+        if len(pcap_tools) > 0:
+            if "main_flow" in cached:
+                main_flow_future = executor.submit(cache.load,
+                                                   cache_entries["main_flow"])
+            else:
+                main_flow_future = executor.submit(get_pcap_main_flow, pcap,
                                                    srcip=srcip)
-    if "PPing" in tools:
-        data["PPing"] = _filter_and_format_data(
-            parse_kpping_rtts(pcap, pping_path=pping_path), srcip=srcip)
-
-    if "ePPing" in tools:
-        epping_file = get_epping_file(root_folder)
-        data["ePPing"] = _filter_and_format_data(
-            ppa_viz.parse_epping_rtts(epping_file), srcip=srcip)
 
+        futures = dict()
+        for tool, (func, _, main_flow_filter) in pcap_tools.items():
+            if tool in cached:
+                future = executor.submit(cache.load, cache_entries[tool])
+            elif main_flow_filter:
+                future = executor.submit(_run_on_main_flow, func, pcap,
+                                         main_flow_future)
+            else:
+                future = executor.submit(func, pcap)
+            futures[future] = tool
+        if "ePPing" in tools:
+            futures[executor.submit(ppa_viz.parse_epping_rtts,
+                                    get_epping_file(root_folder))] = "ePPing"
+
+        main_flow = None
+        if main_flow_future is not None:
+            main_flow = raw_results["main_flow"] = main_flow_future.result()
+        for future in concurrent.futures.as_completed(futures):
+            tool = futures[future]
+            raw_results[tool] = future.result()
+
+            # The tools given the main flow as filter report nothing else
+            if tool in pcap_tools and pcap_tools[tool][2]:
+                tool_flow = main_flow
+            else:
+                tool_flow = get_main_flow(raw_results[tool]["flow"],
+                                          srcip=srcip)
+                if main_flow is not None and tool_flow != main_flow:
+                    print("Warning: main flow of {} is {}, using main flow {} "
+                          "of the pcap instead".format(tool, tool_flow,
+                                                       main_flow),
+                          file=sys.stderr)
+            results[tool] = _filter_and_format_data(
+                raw_results[tool], srcip=srcip,
+                flow=tool_flow if main_flow is None else main_flow)
+
+    # Store new results only once all cached ones are loaded, as storing may
+    # evict entries
+    for key, path in cache_entries.items():
+        if key not in cached:
+            cache.store(path, raw_results[key])
+
+    data = {tool: results[tool]
+            for tool in ("tshark", "tcptrace", "PPing", "ePPing")
+            if tool in results}
+
+    # Base delay from the logged netem changes (for the tools with absolute
+    # timestamps), instead of estimating it from the RTTs
+    schedule_file = get_netem_schedule_file(root_folder)
+    schedule = None
+    if schedule_file is not None:
+        schedule = tra.load_netem_schedule(schedule_file)
+        if len(schedule) < 1:
+            print("Warning: No netem changes in {}, estimating the base delay "
+                  "from the RTTs instead".format(schedule_file), file=sys.stderr)
+            schedule = None
+    if schedule is not None:
+        for tool, df in data.items():
+            if ("timestamp" in df.columns and
+                    np.issubdtype(df["timestamp"].dtype, np.datetime64)):
+                df["base_delay"] = tra.compute_scheduled_base_delay(
+                    df["timestamp"].values, df["rtt"].values, schedule)
+                n_unknown = df["base_delay"].isna().sum()
+                if n_unknown > 0:
+                    print("Warning: Unknown base delay for {} of the RTTs "
+                          "from {}".format(n_unknown, tool), file=sys.stderr)
 
     if normalize_timestamps:
         tstamp_tools = [key for key in data.keys()
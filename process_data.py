@@ -220,8 +220,7 @@ def load_cpu_data(root_folder, omit=0):
         if sarfile is None:
             continue
 
-        j_data = sdl.load_sar_cpu_data(sarfile)
-        data = sdl.to_percpu_df(j_data, filter_timerange=test_interval)
+        data = sdl.load_sar_percpu_dfs(sarfile, filter_timerange=test_interval)
 
         load_dict[label] = data["all"].copy()
 
@@ -239,8 +238,8 @@ def load_network_data(root_folder, interface="ens192", omit=0):
         if sarfile is None:
             continue
 
-        j_data = sdl.load_sar_network_data(get_sarfile(subfolder))
-        data = sdl.to_perinterface_df(j_data, filter_timerange=test_interval)
+        data = sdl.load_sar_perinterface_dfs(sarfile,
+                                             filter_timerange=test_interval)
 
         net_dict[label] = data[interface].copy()
 
@@ -375,12 +374,45 @@ def load_all_data(root_folder, cpu=True, network=True, pping=True, tcp=True,
     return data
 
 
+def _numerize_keys(col, key_func):
+    """
+    Convert string keys like "run_3" to ints with key_func, only calling
+    key_func once per unique key.
+    """
+    codes, uniques = pd.factorize(col)
+    return np.array([key_func(key) for key in uniques], dtype=np.int64)[codes]
+
+
+def compact_dtypes(df, float32=False, exclude_cols=("timestamp",)):
+    """
+    Numerize the n_flows and run columns, make the pping_setup and flow
+    columns categorical and optionally downcast float64 columns (except
+    exclude_cols) to float32. Modifies df inplace.
+    """
+    if "n_flows" in df.columns and not pd.api.types.is_integer_dtype(df["n_flows"]):
+        df["n_flows"] = _numerize_keys(df["n_flows"], _n_streams_key)
+    if "run" in df.columns and not pd.api.types.is_integer_dtype(df["run"]):
+        df["run"] = _numerize_keys(df["run"], _run_n_key)
+
+    for col in ("pping_setup", "flow"):
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+
+    if float32:
+        for col in df.columns:
+            if col not in exclude_cols and df[col].dtype == np.float64:
+                df[col] = df[col].astype(np.float32)
+
+    return df
+
+
 def flatten_per_pping_dict(per_pping_dict):
     return util.pergroup_dict_to_df(per_pping_dict, "pping_setup")
 
 
 def flatten_per_flow_dict(per_flow_dict,
-                          flatten_inner_func=flatten_per_pping_dict):
+                          flatten_inner_func=flatten_per_pping_dict,
+                          float32=False):
     flat_flow_dict = dict()
     for n_flows, data in per_flow_dict.items():
         if isinstance(data, pd.DataFrame):
@@ -388,10 +420,36 @@ def flatten_per_flow_dict(per_flow_dict,
         else:
             flat_flow_dict[n_flows] = flatten_inner_func(data)
 
-    return util.pergroup_dict_to_df(flat_flow_dict, "n_flows")
+    return compact_dtypes(util.pergroup_dict_to_df(flat_flow_dict, "n_flows"),
+                          float32=float32)
 
 
-def merge_all_data(data, **kwargs):
+def _union_categories(dfs, col):
+    """
+    Give the categorical col of all dfs the union of their categories.
+    Returns the CategoricalDtype of the union.
+    """
+    categories = pd.api.types.union_categoricals(
+        [df[col] for df in dfs if col in df.columns]).categories
+    for df in dfs:
+        if col in df.columns:
+            df[col] = df[col].cat.set_categories(categories)
+    return pd.CategoricalDtype(categories)
+
+
+def _set_key_dtype(df, key, dtype):
+    """Set the dtype of key, either an index level or a column, of df"""
+    if key in df.columns:
+        df[key] = df[key].astype(dtype)
+    elif isinstance(df.index, pd.MultiIndex):
+        level = df.index.levels[df.index.names.index(key)]
+        df.index = df.index.set_levels(level.astype(dtype), level=key)
+    elif df.index.name == key:
+        df.index = df.index.astype(dtype)
+    return df
+
+
+def merge_all_data(data, float32=False, **kwargs):
     join_cols = ["n_flows", "pping_setup", "run", "timestamp"]
     flat_data = dict()
 
@@ -402,9 +460,9 @@ def merge_all_data(data, **kwargs):
             continue
 
         if not isinstance(data[data_type], pd.DataFrame):
-            df = flatten_per_flow_dict(data[data_type])
+            df = flatten_per_flow_dict(data[data_type], float32=float32)
         else:
-            df = data[data_type]
+            df = compact_dtypes(data[data_type].copy(), float32=float32)
 
         flat_data[data_type] = \
             util.add_column_prefix_to_df(df, data_type + "_",
@@ -413,8 +471,12 @@ def merge_all_data(data, **kwargs):
     if len(flat_data) < 1:
         raise ValueError("Cannot merge empty data")
 
-    return util.join_dataframes([df for df in flat_data.values()], on=join_cols,
-                                **kwargs)
+    # Joining on categorical keys requires identical categories, and the
+    # join turns the keys back to object, so restore the categorical dtype
+    setup_dtype = _union_categories(list(flat_data.values()), "pping_setup")
+    merged = util.join_dataframes([df for df in flat_data.values()], on=join_cols,
+                                  **kwargs)
+    return _set_key_dtype(merged, "pping_setup", setup_dtype)
 
 
 def main():
@@ -445,6 +507,8 @@ def main():
     parser.add_argument("-F", "--tcp-flows", action="store_true",
                         required=False,
                         help="Include per-flow TCP data (exclusive, cannot be merged with other types of data)")
+    parser.add_argument("--float32", action="store_true", required=False,
+                        help="Store metric columns as float32 instead of float64")
     args = parser.parse_args()
 
     if not (args.cpu or args.network or args.pping or
@@ -464,12 +528,12 @@ def main():
 
     if args.tcp_flows:
         data = load_all_tcp_data(args.input, omit=args.omit, dst=args.dst)
-        df = flatten_per_flow_dict(data)
+        df = flatten_per_flow_dict(data, float32=args.float32)
     else:
         data = load_all_data(args.input, cpu=args.cpu, network=args.network,
                              pping=args.pping, tcp=args.tcp, omit=args.omit,
                              interface=args.interface, dst=args.dst)
-        df = merge_all_data(data)
+        df = merge_all_data(data, float32=args.float32)
 
     df.to_csv(args.output)
 
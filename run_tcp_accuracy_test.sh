@@ -202,18 +202,28 @@ setup_netem() {
     local machine=$1
     local iface=${2:-$NETEM_IFACE}
     local netem_args=${3:-$NETEM_ARGS}
+    local schedule_log=${4:-/dev/null}
 
     echo "${machine}: Setting up netem $netem_args on dev $iface"
-    ssh $machine "sudo tc qdisc add dev $iface root netem $netem_args"
+    # Log the (unix) time on $machine when netem was set up, the tc command
+    # and the netem args
+    local tstamp
+    tstamp=$(ssh $machine "sudo tc qdisc add dev $iface root netem $netem_args && date +%s.%N") &&
+        echo "$tstamp add $netem_args" >> $schedule_log
 }
 
 change_netem() {
     local machine=$1
     local iface=${2:-$NETEM_IFACE}
     local netem_args=${3:-$NETEM_ARGS}
+    local schedule_log=${4:-/dev/null}
 
     echo "${machine}: Changing netem to $netem_args on dev $iface"
-    ssh $machine "sudo tc qdisc change dev $iface root netem $netem_args"
+    # Log the (unix) time on $machine when netem was changed, the tc command
+    # and the netem args
+    local tstamp
+    tstamp=$(ssh $machine "sudo tc qdisc change dev $iface root netem $netem_args && date +%s.%N") &&
+        echo "$tstamp change $netem_args" >> $schedule_log
 }
 
 teardown_netem() {
@@ -286,14 +296,18 @@ if [[ "$ADD_DATETIME_SUBPATH" == true ]]; then
    basepath=${basepath}/${currtime}
 fi
 
+# Schedule of the netem changes, used to find the base delay of each RTT
+netem_schedule="${basepath}/e_pping/netem_schedule.log"
+mkdir -p "${basepath}/e_pping"
+
 is_first=true
 for delay in $NETEM_DELAYS; do
     if [[ "$is_first" == true ]]; then
-	setup_netem $NETEM_MACHINE $NETEM_IFACE "delay $delay"
+	setup_netem $NETEM_MACHINE $NETEM_IFACE "delay $delay" $netem_schedule
 	start_test "${basepath}/e_pping" $n_flows
 	is_first=false
     else
-	change_netem $NETEM_MACHINE $NETEM_IFACE "delay $delay"
+	change_netem $NETEM_MACHINE $NETEM_IFACE "delay $delay" $netem_schedule
     fi
     sleep $PER_DELAY_TEST_LENGTH
 done
@@ -97,8 +97,7 @@ def main():
                         required=False, default=None, const=1)
     args = parser.parse_args()
 
-    cpu_json = sdl.load_sar_cpu_data(args.input)
-    data = sdl.to_percpu_df(cpu_json)
+    data = sdl.load_sar_percpu_dfs(args.input)
     if args.trim is not None:
         data = trim_only_under_load(data, load_thresh=args.trim)
 
@@ -2,6 +2,7 @@
 import json
 import subprocess
 import os
+import itertools
 
 import numpy as np
 import pandas as pd
@@ -10,46 +11,178 @@ import util
 
 
 def _run_on_xz_file(func, filename, *args, **kwargs):
-    filename = str(filename)
-    orig_filename = filename
-
-    if filename.endswith(".xz"):
-        util.xz_decompress_file(filename)
-        filename = filename[:-3]
-
-    try:
-        res = func(filename, *args, **kwargs)
-    finally:
-        if filename != orig_filename:
-            os.remove(filename)
-
-    return res
-
-
-def _load_sar_network_data(filename):
-
-    p = subprocess.run(["sadf", "-j", filename, "--", "-n", "DEV", "-n", "EDEV"],
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    """
+    Run func on a decompressed version of filename (from the shared
+    decompression cache if filename is compressed).
+    """
+    with util.decompressed_file(filename) as filename:
+        return func(filename, *args, **kwargs)
+
+
+# Run sadf in UTC so that the -s limit matches the (UTC) test intervals
+_sadf_env = dict(os.environ, TZ="UTC")
+
+
+def _sadf_time_args(timerange, slack=np.timedelta64(1, "s")):
+    """
+    sadf -s argument skipping the records before timerange. sadf only takes
+    the time of day, so nothing is skipped if the timerange crosses
+    midnight. The end is not passed as -e, as sadf shifts records after
+    midnight by 24h when comparing them against -e, which could then
+    exclude records within timerange.
+    """
+    if timerange is None:
+        return []
+
+    start = np.datetime64(timerange[0], "s") - slack
+    end = np.datetime64(timerange[1], "s") + slack
+    if start.astype("datetime64[D]") != end.astype("datetime64[D]"):
+        return []
+    return ["-s", str(start)[11:19]]
+
+
+def _parse_sadf_timestamps(timestamps):
+    """Parse the "%Y-%m-%d %H:%M:%S UTC" timestamps once per unique value"""
+    codes, uniques = pd.factorize(timestamps)
+    uniques = pd.to_datetime(pd.Index(uniques).str[:19],
+                             format="%Y-%m-%d %H:%M:%S")
+    return uniques.values[codes]
+
+
+def _load_sar_network_data(filename, timerange=None):
+
+    p = subprocess.run(["sadf", "-j"] + _sadf_time_args(timerange) +
+                       [filename, "--", "-n", "DEV", "-n", "EDEV"],
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       env=_sadf_env)
     if p.returncode != 0:
         raise ChildProcessError("sadf failed: {}".format(p.stderr))
     return json.loads(p.stdout)["sysstat"]["hosts"][0]
 
 
-def load_sar_network_data(filename):
-    return _run_on_xz_file(_load_sar_network_data, filename)
+def load_sar_network_data(filename, timerange=None):
+    return _run_on_xz_file(_load_sar_network_data, filename, timerange)
 
 
-def _load_sar_cpu_data(filename):
+def _load_sar_cpu_data(filename, timerange=None):
 
-    p = subprocess.run(["sadf", "-j", filename, "--", "-P", "ALL", "-u", "ALL"],
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    p = subprocess.run(["sadf", "-j"] + _sadf_time_args(timerange) +
+                       [filename, "--", "-P", "ALL", "-u", "ALL"],
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       env=_sadf_env)
     if p.returncode != 0:
         raise ChildProcessError("sadf failed: {}".format(p.stderr))
     return json.loads(p.stdout)["sysstat"]["hosts"][0]
 
 
-def load_sar_cpu_data(filename):
-    return _run_on_xz_file(_load_sar_cpu_data, filename)
+def load_sar_cpu_data(filename, timerange=None):
+    return _run_on_xz_file(_load_sar_cpu_data, filename, timerange)
+
+
+def _load_sadf_csv(filename, sar_args, timerange=None, chunksize=1 << 16):
+    """
+    Stream the output of sadf -d (one line per cpu/interface and period) into
+    a long-format DataFrame. Column names are stripped of % and /s to match
+    the keys in the output of sadf -j. If timerange is given, sadf skips the
+    records before it and reading stops after it, but the returned rows are
+    not filtered exactly on it.
+    """
+    p = subprocess.Popen(["sadf", "-d"] + _sadf_time_args(timerange) +
+                         [filename, "--"] + sar_args,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         env=_sadf_env)
+    header = p.stdout.readline().decode().lstrip("# ").rstrip("\n").split(";")
+    cols = [col.lstrip("%").replace("/s", "") for col in header]
+    end = None if timerange is None else np.datetime64(timerange[1], "s")
+
+    chunks = list()
+    stopped_early = False
+    if len(cols) > 3:
+        # Later headers (ex. after restarts) are skipped as comments
+        reader = pd.read_csv(p.stdout, sep=";", header=None, names=cols,
+                             comment="#", dtype={cols[3]: str},
+                             chunksize=chunksize)
+        for chunk in reader:
+            chunk["timestamp"] = _parse_sadf_timestamps(chunk["timestamp"])
+            chunks.append(chunk)
+            # Stop reading once past the end of the timerange
+            if end is not None and chunk["timestamp"].values[-1] > end:
+                stopped_early = True
+                break
+    p.stdout.close()
+    if stopped_early:
+        p.kill()
+    stderr = p.stderr.read()
+    if (p.wait() != 0 and not stopped_early) or len(cols) <= 3:
+        raise ChildProcessError("sadf failed: {}".format(stderr))
+
+    df = (pd.concat(chunks, ignore_index=True) if len(chunks) > 0
+          else pd.DataFrame(columns=cols))
+    # Restart markers are reported with an interval of -1
+    df = df.loc[df["interval"] >= 0].reset_index(drop=True)
+
+    return df.drop(columns=["hostname", "interval"])
+
+
+def _load_sar_cpu_df(filename, timerange=None):
+    df = _load_sadf_csv(filename, ["-P", "ALL", "-u", "ALL"], timerange)
+    df.rename(columns={"CPU": "cpu"}, inplace=True)
+    df["cpu"] = df["cpu"].replace("-1", "all")
+    n_cpus = df.loc[df["cpu"] != "all", "cpu"].nunique()
+    return _convert_cpu_load(df, n_cpus)
+
+
+def _load_sar_network_df(filename, timerange=None):
+    dev = _load_sadf_csv(filename, ["-n", "DEV"], timerange)
+    edev = _load_sadf_csv(filename, ["-n", "EDEV"], timerange)
+
+    dev = dev.rename(columns={"IFACE": "iface", "rxkB": "rxbps", "txkB": "txbps",
+                              "rxpck": "rxpps", "txpck": "txpps"})
+    dev = dev[["timestamp", "iface", "rxbps", "txbps", "rxpps", "txpps"]]
+    edev = edev.rename(columns={"IFACE": "iface"})
+    dev = dev.merge(edev[["timestamp", "iface", "rxdrop", "txdrop", "rxerr", "txerr"]],
+                    on=["timestamp", "iface"], how="left")
+    dev["rxbps"] = dev["rxbps"] * 8 * 1000
+    dev["txbps"] = dev["txbps"] * 8 * 1000
+    return dev
+
+
+def load_sar_percpu_dfs(filename, filter_timerange=None, norm_timestamps=True,
+                        backend="csv"):
+    """
+    Load per-CPU load DataFrames from a sar file, either by parsing the
+    sadf -d output (backend="csv") or the sadf -j output (backend="json").
+    filter_timerange is also passed on to sadf, so that it only outputs
+    the records within it.
+    """
+    if backend == "json":
+        return to_percpu_df(load_sar_cpu_data(filename, filter_timerange),
+                            filter_timerange=filter_timerange,
+                            norm_timestamps=norm_timestamps)
+    if backend != "csv":
+        raise ValueError("backend must be 'csv' or 'json'")
+
+    df = _run_on_xz_file(_load_sar_cpu_df, filename, filter_timerange)
+    return _long_df_to_pergroup(df, "cpu", filter_timerange, norm_timestamps)
+
+
+def load_sar_perinterface_dfs(filename, filter_timerange=None,
+                              norm_timestamps=True, backend="csv"):
+    """
+    Load per-interface network DataFrames from a sar file, either by parsing
+    the sadf -d output (backend="csv") or the sadf -j output (backend="json").
+    filter_timerange is also passed on to sadf, so that it only outputs
+    the records within it.
+    """
+    if backend == "json":
+        return to_perinterface_df(load_sar_network_data(filename, filter_timerange),
+                                  filter_timerange=filter_timerange,
+                                  norm_timestamps=norm_timestamps)
+    if backend != "csv":
+        raise ValueError("backend must be 'csv' or 'json'")
+
+    df = _run_on_xz_file(_load_sar_network_df, filename, filter_timerange)
+    return _long_df_to_pergroup(df, "iface", filter_timerange, norm_timestamps)
 
 
 def get_timestamps(sar_json):
@@ -58,83 +191,84 @@ def get_timestamps(sar_json):
     return np.array(ts, dtype="datetime64")
 
 
-def to_perinterface_df(sar_json, filter_timerange=None, norm_timestamps=True):
-    dev_keymap = {"rxbps": "rxkB", "txbps": "txkB", "rxpps": "rxpck", "txpps": "txpck"}
-    edev_keymap = {key: key for key in ["rxdrop", "txdrop", "rxerr", "txerr"]}
-    interface_data = dict()
+def _flatten_periods(sar_json, ts, get_entries):
+    """
+    Flatten the (per cpu/interface) entries from all periods into a single
+    long-format DataFrame, with the timestamp of each period as first column.
+    """
+    entries = [get_entries(period) for period in sar_json["statistics"]]
+    df = pd.DataFrame.from_records(list(itertools.chain.from_iterable(entries)))
+    df.insert(0, "timestamp", np.repeat(ts, [len(entry) for entry in entries]))
+    return df
 
-    ts = get_timestamps(sar_json)
 
-    for period in sar_json["statistics"]:
-        for if_entry in period["network"]["net-dev"]:
-            iface = if_entry["iface"]
-
-            if iface not in interface_data:
-                interface_data[iface] = {key: [] for key in
-                                         (list(dev_keymap.keys())
-                                          + list(edev_keymap.keys()))}
-            for key1, key2 in dev_keymap.items():
-                interface_data[iface][key1].append(if_entry[key2])
+def _long_df_to_pergroup(df, group_col, filter_timerange, norm_timestamps):
+    time_ref = None if filter_timerange is None else filter_timerange[0]
+    group_df = dict()
 
-        for if_entry in period["network"]["net-edev"]:
-            iface = if_entry["iface"]
-            for key1, key2 in edev_keymap.items():
-                interface_data[iface][key1].append(if_entry[key2])
+    for group, data in df.groupby(group_col, sort=False):
+        data = data.drop(columns=group_col).reset_index(drop=True)
+        group_df[group] = _filter_and_norm_df(data, filter_timerange,
+                                              norm_timestamps, time_ref)
 
-    interface_data = _groupwise_dict_to_df(interface_data, ts,
-                                           filter_timerange, norm_timestamps)
-    for iface, df in interface_data.items():
-        df["rxbps"] = df["rxbps"] * 8 * 1000
-        df["txbps"] = df["txbps"] * 8 * 1000
+    return group_df
 
-    return interface_data
 
+def to_perinterface_df(sar_json, filter_timerange=None, norm_timestamps=True):
+    dev_keymap = {"rxkB": "rxbps", "txkB": "txbps", "rxpck": "rxpps", "txpck": "txpps"}
+    edev_keys = ["rxdrop", "txdrop", "rxerr", "txerr"]
 
-def to_percpu_df(sar_json, norm_timestamps=True, filter_timerange=None):
-    n_cpus = sar_json["number-of-cpus"]
     ts = get_timestamps(sar_json)
+    dev = _flatten_periods(sar_json, ts,
+                           lambda period: period["network"]["net-dev"])
+    edev = _flatten_periods(sar_json, ts,
+                            lambda period: period["network"]["net-edev"])
 
-    per_cpu = dict()
-    for period in sar_json["statistics"]:
-        for entry in period["cpu-load"]:
-            cpu = entry["cpu"]
-            mult = n_cpus if cpu == "all" else 1
-            if cpu not in per_cpu:
-                per_cpu[cpu] = dict()
+    dev = dev[["timestamp", "iface"] + list(dev_keymap.keys())].rename(
+        columns=dev_keymap)
+    dev = dev.merge(edev[["timestamp", "iface"] + edev_keys],
+                    on=["timestamp", "iface"], how="left")
+    dev["rxbps"] = dev["rxbps"] * 8 * 1000
+    dev["txbps"] = dev["txbps"] * 8 * 1000
 
-            for loadtype, load in entry.items():
-                if loadtype == "cpu":
-                    continue
-                if loadtype == "idle":
-                    loadtype = "total"
-                if loadtype not in per_cpu[cpu]:
-                    per_cpu[cpu][loadtype] = []
+    return _long_df_to_pergroup(dev, "iface", filter_timerange,
+                                norm_timestamps)
 
-                if loadtype == "total":
-                    per_cpu[cpu]["total"].append((100 - load) * mult)
-                else:
-                    per_cpu[cpu][loadtype].append(load * mult)
 
-    return _groupwise_dict_to_df(per_cpu, ts, filter_timerange,
-                                 norm_timestamps)
+def cpu_load_to_long_df(stat_json, ts):
+    """
+    Long-format DataFrame of the cpu-load entries from sadf -j or mpstat -o
+    JSON. Loads for "all" are multiplied by the number of CPUs and idle is
+    converted to total.
+    """
+    df = _flatten_periods(stat_json, ts, lambda period: period["cpu-load"])
+    return _convert_cpu_load(df, stat_json["number-of-cpus"])
 
 
-def _groupwise_dict_to_df(group_dict, ts, filter_timerange, norm_timestamps):
-    group_df = dict()
-    time_ref = None if filter_timerange is None else filter_timerange[0]
+def _convert_cpu_load(df, n_cpus):
+    mult = np.where(df["cpu"].values == "all", n_cpus, 1)
+    for loadtype in df.columns:
+        if loadtype in ("timestamp", "cpu"):
+            continue
+        if loadtype == "idle":
+            df[loadtype] = (100 - df[loadtype].values) * mult
+        else:
+            df[loadtype] = df[loadtype].values * mult
 
-    for group, data in group_dict.items():
-        df = pd.DataFrame(data)
-        df.insert(0, "timestamp", ts)
+    return df.rename(columns={"idle": "total"})
 
-        if filter_timerange is not None:
-            df = df.loc[df["timestamp"].between(filter_timerange[0],
-                                                filter_timerange[1])]
-            df.reset_index(drop=True, inplace=True)
 
-        if norm_timestamps:
-            df["timestamp"] = util.normalize_timestamps(df["timestamp"], time_ref)
+def to_percpu_df(sar_json, norm_timestamps=True, filter_timerange=None):
+    df = cpu_load_to_long_df(sar_json, get_timestamps(sar_json))
+    return _long_df_to_pergroup(df, "cpu", filter_timerange, norm_timestamps)
 
-        group_df[group] = df
 
-    return group_df
+def _filter_and_norm_df(df, filter_timerange, norm_timestamps, time_ref):
+    if filter_timerange is not None:
+        df = df.loc[df["timestamp"].between(
+            filter_timerange[0], filter_timerange[1])].reset_index(drop=True)
+
+    if norm_timestamps:
+        df["timestamp"] = util.normalize_timestamps(df["timestamp"], time_ref)
+
+    return df
@@ -113,8 +113,7 @@ def main():
     parser.add_argument("-T", "--title", type=str, help="figure title", required=False)
     args = parser.parse_args()
 
-    net_json = sdl.load_sar_network_data(args.input)
-    data = sdl.to_perinterface_df(net_json)
+    data = sdl.load_sar_perinterface_dfs(args.input)
 
     fig = plot_interface_stats(data, args.interface, title=args.title)
 
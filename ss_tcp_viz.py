@@ -6,148 +6,373 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import argparse
 import sys
+import re
+import os
+import multiprocessing
+import array
 
 import util
 import common_plotting as complot
 
+_timestamp_pattern = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?")
+_tcp_value_pattern = re.compile(r"\s(bytes_retrans|bytes_sent|rtt|retrans):(\S+)")
+_delivery_rate_pattern = re.compile(r"\sdelivery_rate\s+(\S+)")
+
+
+# Fields parsed from each ss entry and the array typecodes they are stored as
+_tcp_fields = (("bytes_retrans", "q"), ("bytes_sent", "q"),
+               ("delivery_rate", "d"), ("rtt", "d"), ("rttvar", "d"),
+               ("curr_retrans", "q"), ("retrans_tot", "q"))
+
 
 def load_ss_tcp_data(filename, filter_timerange=None, norm_timestamps=True,
                      dst=None, sum_flows=True, filter_main_flows=False,
-                     **kwargs):
+                     processes=1, **kwargs):
     """
-    Parses data from ss -tiO >> filename.
+    Parses data from ss -tiO >> filename into a dict with a DataFrame
+    per flow (and the summary of all flows as "all" if sum_flows).
 
     Timestamps of format %Y-%m-%dT%H:%M:%S are expected either at the
     beginning of each line, at the beginning of some lines or on
     separate lines. Any entries before the first timestamp is encountered
     will be ignored.
+
+    If processes is not 1, the file is split at timestamp lines and the
+    parts are parsed in a pool of processes (None for one per CPU).
     """
-    flow_data = dict()
+    df = load_ss_tcp_long_df(filename, filter_timerange=filter_timerange,
+                             norm_timestamps=norm_timestamps, dst=dst,
+                             filter_main_flows=filter_main_flows,
+                             processes=processes, **kwargs)
+    if df is None:
+        return dict()
 
-    current_ts = None
+    flow_dfs = long_df_to_flow_dfs(df)
 
-    with util.open_compressed_file(filename, mode="rt") as file:
-        for line in file:
-            tcp_info = parse_tcp_entry(line)
-            current_ts = tcp_info.get("timestamp", current_ts)
-            if "flow" not in tcp_info:
-                continue
-            flow = tcp_info["flow"]
-            if dst is not None and not flow.split("+")[1].startswith(dst):
-                continue
+    if sum_flows:
+        flow_dfs["all"] = summarize_long_df(df)
+
+    return flow_dfs
 
-            if flow not in flow_data:
-                fields = set(list(tcp_info.keys())) - set(["timestamp", "flow"])
-                flow_data[flow] = {field: [] for field in fields.union(set(["timestamp"]))}
 
-            flow_data[flow]["timestamp"].append(tcp_info.get("timestamp", current_ts))
-            for field in fields:
-                flow_data[flow][field].append(tcp_info[field])
+def load_ss_tcp_long_df(filename, filter_timerange=None, norm_timestamps=True,
+                        dst=None, filter_main_flows=False, processes=1,
+                        **kwargs):
+    """
+    Parses data from ss -tiO >> filename into a single long-format
+    DataFrame, with the entries of each flow (a categorical "flow" column)
+    after each other in order of their first appearance. Returns None if
+    no flows are found. See load_ss_tcp_data for the arguments.
+
+    The derived columns and the main flow filter (see
+    filter_likely_main_flows) are computed on the parsed columns, so the
+    DataFrame is only built for the entries that are kept.
+    """
+    if processes == 1:
+        with util.open_compressed_file(filename, mode="rt") as file:
+            flows, columns = _parse_ss_lines(file, dst)
+    else:
+        flows, columns = _parse_ss_file_parallel(filename, dst, processes)
 
-    if len(flow_data) < 1:
-        return flow_data
+    if len(flows) < 1:
+        return None
 
-    # Convert to dataframe and apply filters
-    flow_dfs = dict()
+    # Put the entries of each flow after each other, keeping their order
+    columns = _columns_to_arrays(columns)
+    order = np.argsort(columns["flow"], kind="stable")
+    columns = {col: vals[order] for col, vals in columns.items()}
+    first = _first_of_flow_mask(columns["flow"])
 
-    time_ref = (min(data["timestamp"][0] for data in flow_data.values())
-                if filter_timerange is None else filter_timerange[0])
+    time_ref = (columns["timestamp"][first].min() if filter_timerange is None
+                else filter_timerange[0])
 
-    n_dup = max(_nr_duplicated(data["timestamp"]) for
-                data in flow_data.values())
+    dup_mask = _duplicated_mask(columns["flow"], columns["timestamp"])
+    n_dup = np.bincount(columns["flow"][dup_mask]).max(initial=0)
     if n_dup > 0:
         print("Warning: {} duplicated timestamps in {}".format(
             n_dup, filename), file=sys.stderr)
+    columns = {col: vals[~dup_mask] for col, vals in columns.items()}
+
+    _add_derived_columns(columns, _first_of_flow_mask(columns["flow"]))
 
-    for flow, data in flow_data.items():
-        df = _dict_to_df(data, filter_timerange, norm_timestamps, time_ref)
-        if len(df) > 0:
-            flow_dfs[flow] = df
+    keep = np.ones(len(columns["flow"]), dtype=bool)
+    if filter_timerange is not None:
+        ts = columns["timestamp"]
+        keep = ((ts >= np.datetime64(filter_timerange[0])) &
+                (ts <= np.datetime64(filter_timerange[1])))
 
     if filter_main_flows:
-        filt_flows = filter_likely_main_flows(flow_dfs, **kwargs)
-        if len(filt_flows) > 0:
-            flow_dfs = filt_flows
+        main_flows = _main_flow_mask(columns["flow"][keep],
+                                     columns["throughput"][keep],
+                                     len(flows), **kwargs)
+        if np.any(main_flows):
+            keep &= main_flows[columns["flow"]]
         else:
             print("Warning: Attempting to filter main flows yielded no valid flows. Skipping this step")
 
-    if sum_flows:
-        flow_dfs["all"] = summarize_flows(flow_dfs)
+    df = _arrays_to_df(flows, {col: vals[keep] for col, vals in columns.items()})
+
+    if norm_timestamps:
+        df["timestamp"] = util.normalize_timestamps(df["timestamp"], time_ref)
+
+    return df
+
+
+def long_df_to_flow_dfs(df):
+    """Split a long-format DataFrame into a dict with a DataFrame per flow"""
+    if df is None:
+        return dict()
+    cols = [col for col in df.columns if col != "flow"]
+    return {flow: data[cols].reset_index(drop=True) for flow, data
+            in df.groupby("flow", sort=False, observed=True)}
+
+
+def _parse_ss_lines(lines, dst=None):
+    """
+    Parse lines from ss -tiO into a list of the flows and a dict with an
+    array per column. The flow column holds the index of the flow in the
+    list of flows.
+    """
+    flows = list()
+    flow_ids = dict()
+    columns = {"flow": array.array("q"), "timestamp": array.array("q")}
+    columns.update({field: array.array(typecode)
+                    for field, typecode in _tcp_fields})
+    field_columns = [(field, columns[field]) for field, _ in _tcp_fields]
+
+    current_ts = None
+
+    for line in lines:
+        # Skip lines for other destinations without tokenizing them
+        if dst is not None and dst not in line:
+            current_ts = parse_timestamp(line.split(maxsplit=1), current_ts)
+            continue
+
+        tcp_info = parse_tcp_entry(line)
+        current_ts = tcp_info.get("timestamp", current_ts)
+        if "flow" not in tcp_info or current_ts is None:
+            continue
+        flow = tcp_info["flow"]
+        if dst is not None and not flow.split("+")[1].startswith(dst):
+            continue
+
+        if flow not in flow_ids:
+            flow_ids[flow] = len(flows)
+            flows.append(flow)
+
+        columns["flow"].append(flow_ids[flow])
+        columns["timestamp"].append(
+            current_ts.astype("datetime64[ns]").astype(np.int64))
+        for field, column in field_columns:
+            column.append(tcp_info[field])
+
+    return flows, columns
+
+
+def _parse_ss_byte_range(filename, start, stop, dst=None):
+    with open(filename, "rb") as file:
+        file.seek(start)
+        text = file.read(stop - start).decode()
+    return _parse_ss_lines(util._split_lines(text), dst)
+
+
+def _timestamp_line_offsets(filename, n_parts):
+    """
+    Byte offsets splitting (uncompressed) filename into at most n_parts
+    parts, each (except possibly the first) starting at a timestamp line.
+    """
+    with util.LineIndexedFile(filename, compression="none") as file:
+        bounds = [0]
+        for i in range(1, n_parts):
+            line_nr = max(i * len(file) // n_parts, bounds[-1] + 1)
+            while (line_nr < len(file) and
+                   parse_timestamp(file[line_nr].split(maxsplit=1)) is None):
+                line_nr += 1
+            if line_nr >= len(file):
+                break
+            bounds.append(line_nr)
+        bounds.append(len(file))
+
+        return file.offsets[bounds].tolist()
+
+
+def _merge_flow_columns(parts):
+    """
+    Merge the flows and columns from consecutive parts of a file, mapping
+    the flow indices of each part to those of the merged list of flows.
+    """
+    flows = list()
+    flow_ids = dict()
+    columns = None
+    for part_flows, part_columns in parts:
+        for flow in part_flows:
+            if flow not in flow_ids:
+                flow_ids[flow] = len(flows)
+                flows.append(flow)
+        id_map = np.array([flow_ids[flow] for flow in part_flows], dtype=np.int64)
+        part_columns["flow"] = array.array(
+            "q", id_map[np.frombuffer(part_columns["flow"], dtype=np.int64)].tobytes())
+
+        if columns is None:
+            columns = part_columns
+            continue
+        for col, vals in part_columns.items():
+            columns[col].extend(vals)
+
+    return flows, columns
+
+
+def _parse_ss_file_parallel(filename, dst=None, processes=None):
+    if processes is None:
+        processes = os.cpu_count()
+
+    with util.decompressed_file(filename) as filename:
+        offsets = _timestamp_line_offsets(filename, 4 * processes)
+        with multiprocessing.Pool(processes) as pool:
+            parts = pool.starmap(_parse_ss_byte_range,
+                                 [(filename, start, stop, dst) for start, stop
+                                  in zip(offsets[:-1], offsets[1:])])
+
+    return _merge_flow_columns(parts)
+
+
+def _columns_to_arrays(columns):
+    arrays = {"flow": np.frombuffer(columns["flow"], dtype=np.int64),
+              "timestamp": np.frombuffer(columns["timestamp"], dtype=np.int64).view(
+                  "datetime64[ns]")}
+    for field, typecode in _tcp_fields:
+        arrays[field] = np.frombuffer(columns[field], dtype=np.dtype(typecode))
+    return arrays
+
+
+def _arrays_to_df(flows, arrays):
+    df = pd.DataFrame({col: vals for col, vals in arrays.items()
+                       if col != "flow"})
+    df.insert(0, "flow", pd.Categorical.from_codes(arrays["flow"],
+                                                   categories=flows))
+    df["flow"] = df["flow"].cat.remove_unused_categories()
+    return df
 
-    return flow_dfs
 
+def _first_of_flow_mask(flow_ids):
+    """Mask of the first entry of each flow in an array sorted by flow"""
+    first = np.ones(len(flow_ids), dtype=bool)
+    first[1:] = flow_ids[1:] != flow_ids[:-1]
+    return first
 
-def _nr_duplicated(vals):
-    return len(vals) - len(pd.unique(vals))
 
+def _duplicated_mask(flow_ids, timestamps):
+    """Mask of the entries with a timestamp already seen for the flow"""
+    return pd.DataFrame({"flow": flow_ids, "timestamp": timestamps}).duplicated().values
 
-def _dict_to_df(ss_dict, filter_timerange, norm_timestamps, time_ref=None):
-    df = pd.DataFrame(ss_dict).drop_duplicates(subset="timestamp")
 
-    interval_lengths = np.empty(len(df), dtype=float)
-    interval_lengths[0] = np.inf
-    interval_lengths[1:] = np.diff(df["timestamp"].values)/np.timedelta64(1, "s")
+def _add_derived_columns(columns, first):
+    """
+    Add throughput and retrans/s columns, computed from the difference to
+    the previous entry of the same flow, and mask rtt, rttvar and
+    delivery_rate for entries where no data was sent.
+    """
+    interval_lengths = np.empty(len(first), dtype=float)
+    interval_lengths[1:] = np.diff(columns["timestamp"])/np.timedelta64(1, "s")
+    interval_lengths[first] = np.inf
 
-    bytes_inc = df["bytes_sent"].values.copy()
-    bytes_inc[1:] = np.diff(bytes_inc)
+    bytes_inc = _flow_diff(columns["bytes_sent"], first)
     bytes_inc[bytes_inc < 0] = 0
-    df["throughput"] = bytes_inc * 8 / interval_lengths
+    columns["throughput"] = bytes_inc * 8 / interval_lengths
 
-    retrans_inc = df["retrans_tot"].values.copy()
-    retrans_inc[1:] = np.diff(retrans_inc)
+    retrans_inc = _flow_diff(columns["retrans_tot"], first)
     retrans_inc[retrans_inc < 0] = 0
-    df["retrans/s"] = retrans_inc / interval_lengths
+    columns["retrans/s"] = retrans_inc / interval_lengths
 
     invalid_mask = bytes_inc == 0
-    df["rtt"].values[invalid_mask] = np.nan
-    df["rttvar"].values[invalid_mask] = np.nan
-    df["delivery_rate"].values[invalid_mask] = 0
+    for field, fill in (("rtt", np.nan), ("rttvar", np.nan),
+                        ("delivery_rate", 0)):
+        columns[field] = np.where(invalid_mask, fill, columns[field])
 
-    if filter_timerange is not None:
-        df = df.loc[df["timestamp"].between(*filter_timerange)]
-        df.reset_index(drop=True, inplace=True)
 
-    if norm_timestamps:
-        df["timestamp"] = util.normalize_timestamps(df["timestamp"], time_ref)
+def _flow_diff(vals, first):
+    """Difference to the previous value of the same flow (itself if first)"""
+    diff = vals.copy()
+    diff[1:] = np.diff(vals)
+    diff[first] = vals[first]
+    return diff
 
-    return df
+
+def _main_flow_mask(flow_ids, throughput, n_flows, thresh=1e6, min_entries=10,
+                    agg_func=np.median):
+    """
+    Mask (indexed by flow id) of the flows filter_likely_main_flows would
+    keep, given the (sorted) flow ids and throughput of all entries. For
+    the median, whether it exceeds thresh is decided by counting the
+    entries above thresh, so it is only computed for the flows where
+    exactly half of them are.
+    """
+    n = np.bincount(flow_ids, minlength=n_flows)
+    candidates = n > min_entries
+
+    if agg_func is np.median:
+        n_above = np.bincount(flow_ids[throughput > thresh], minlength=n_flows)
+        keep = candidates & (2 * n_above > n)
+        undecided = np.flatnonzero(candidates & (2 * n_above == n))
+    else:
+        keep = np.zeros(n_flows, dtype=bool)
+        undecided = np.flatnonzero(candidates)
+
+    # flow_ids are sorted, so the entries of each flow are a contiguous slice
+    starts = np.searchsorted(flow_ids, undecided, side="left")
+    ends = np.searchsorted(flow_ids, undecided, side="right")
+    for flow_id, start, end in zip(undecided, starts, ends):
+        keep[flow_id] = agg_func(pd.Series(throughput[start:end])) > thresh
+
+    return keep
 
 
 def summarize_flows(flow_dfs, stepsize=np.timedelta64(1, "s")):
+    if len(flow_dfs) < 1:
+        return None
+    return summarize_long_df(pd.concat(flow_dfs.values(), ignore_index=True),
+                             stepsize)
+
+
+def summarize_long_df(df, stepsize=np.timedelta64(1, "s")):
+    """
+    Summarize the flows in a long-format DataFrame (sorted by flow) per
+    timestamp, summing throughput, delivery_rate and retrans/s and
+    averaging rtt and rttvar.
+    """
     sum_fields = ("throughput", "delivery_rate", "retrans/s")
     mean_fields = ("rtt", "rttvar")
     fields = sum_fields + mean_fields
-    if len(flow_dfs) < 1:
+    if len(df) < 1:
         return None
 
-    start = min(df["timestamp"].values[0] for df in flow_dfs.values())
-    end = max(df["timestamp"].values[-1] for df in flow_dfs.values())
+    start = df["timestamp"].values.min()
+    end = df["timestamp"].values.max()
 
     step = stepsize if np.issubdtype(start, np.datetime64) else stepsize/np.timedelta64(1, "s")
     ts = np.arange(start, end+1, step)
 
-    ts_entries = {t: {field: {"sum": 0, "n": 0} for field in fields} for t in ts}
-
-    for flow, df in flow_dfs.items():
-        for row in range(len(df)):
-            t = df["timestamp"].values[row]
-            for field in fields:
-                val = df[field].values[row]
-                if not np.isnan(val):
-                    ts_entries[t][field]["sum"] += val
-                    ts_entries[t][field]["n"] += 1
-
-    cleaned_entries = {t: dict() for t in ts_entries.keys()}
-    for t, entry in ts_entries.items():
-        for field, val in entry.items():
-            if field in mean_fields:
-                cleaned_entries[t][field] = val["sum"]/val["n"] if val["n"] > 0 else np.nan
-            else:
-                cleaned_entries[t][field] = val["sum"]
-
-    sum_df = pd.DataFrame.from_dict(cleaned_entries, orient="index")
-    sum_df.index.name = "timestamp"
-    sum_df.reset_index(inplace=True)
+    # Map every entry to its index in ts
+    ts_idx = pd.Index(ts).get_indexer(df["timestamp"].values)
+    if np.any(ts_idx < 0):
+        raise KeyError("timestamps not aligned to stepsize {}".format(stepsize))
+
+    # Sum/count per timestamp with bincount, which (unlike groupby sum) adds
+    # the values in order without compensation, matching a sequential sum
+    sum_df = pd.DataFrame({"timestamp": ts})
+    for field in fields:
+        vals = df[field].values.astype(float)
+        valid = ~np.isnan(vals)
+        n = np.bincount(ts_idx[valid], minlength=len(ts))
+        field_sum = np.bincount(ts_idx[valid], weights=vals[valid],
+                                minlength=len(ts))
+
+        if field in mean_fields:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                sum_df[field] = np.where(n > 0, field_sum / n, np.nan)
+        else:
+            sum_df[field] = field_sum if np.any(n > 0) else np.zeros(len(ts), dtype=int)
+
     return sum_df
 
 
@@ -158,21 +383,30 @@ def filter_likely_main_flows(flow_dfs, thresh=1e6, min_entries=10,
             len(data["throughput"]) > min_entries}
 
 
+def parse_timestamp(words, not_found_val=None):
+    """
+    Parse the timestamp from a (split) line if the first word is a timestamp
+    in the %Y-%m-%dT%H:%M:%S format.
+    """
+    if len(words) > 0 and _timestamp_pattern.fullmatch(words[0]) is not None:
+        return np.datetime64(words[0])
+    return not_found_val
+
+
 def parse_tcp_entry(line):
     """
     Parses a line from the output of ss -tiO, may optionally be prepended by a timestamp.
     """
     info = dict()
 
-    parts = line.rstrip("\n").split()
+    parts = line.split()
     if len(parts) < 1:
         return info
 
     if parts[0] != "ESTAB":
-        try:
-            info["timestamp"] = np.datetime64(parts[0])
-        except ValueError:
-            pass
+        ts = parse_timestamp(parts)
+        if ts is not None:
+            info["timestamp"] = ts
         estab_idx = 1
     else:
         estab_idx = 0
@@ -184,34 +418,24 @@ def parse_tcp_entry(line):
     # Parse TCP fields
     info["flow"] = parts[estab_idx + 3] + "+" + parts[estab_idx + 4]
 
-    parts = parts[estab_idx + 4:]
-
-    info["bytes_retrans"] = parse_bytes_retrans(parts)
-    info["bytes_sent"] = parse_bytes_sent(parts) - info["bytes_retrans"]
-    info["delivery_rate"] = parse_delivery_rate(parts)
-    rtt, rttvar = parse_rtt(parts)
-    info["rtt"] = rtt
-    info["rttvar"] = rttvar
-    retrans, retrans_tot = parse_retrans(parts)
-    info["curr_retrans"] = retrans
-    info["retrans_tot"] = retrans_tot
+    # Only the first occurrence of each key counts
+    values = dict(reversed(_tcp_value_pattern.findall(line)))
+    delivery_rate = _delivery_rate_pattern.search(line)
+
+    info["bytes_retrans"] = int(values.get("bytes_retrans", "0"))
+    info["bytes_sent"] = int(values.get("bytes_sent", "0")) - info["bytes_retrans"]
+    info["delivery_rate"] = bps_str_to_numeric(
+        delivery_rate.group(1) if delivery_rate is not None else "0bps")
+    rtt, rttvar = values.get("rtt", "NaN/NaN").split("/")
+    info["rtt"] = float(rtt)
+    info["rttvar"] = float(rttvar)
+    retrans, retrans_tot = values.get("retrans", "0/0").split("/")
+    info["curr_retrans"] = int(retrans)
+    info["retrans_tot"] = int(retrans_tot)
 
     return info
 
 
-def find_tcp_value(keyword, words, not_found_val=None):
-    colon_scheme = True if keyword.endswith(":") else False
-
-    for i, word in enumerate(words):
-        if colon_scheme:
-            if word.startswith(keyword):
-                return word[len(keyword):]
-        else:
-            if word == keyword:
-                return words[i+1]
-    return not_found_val
-
-
 def bps_str_to_numeric(bps_str):
     for prefix, factor in (("M", 1e6), ("K", 1e3), ("", 1)):
         if bps_str.endswith(prefix + "bps"):
@@ -219,28 +443,6 @@ def bps_str_to_numeric(bps_str):
     raise ValueError("{} does not appear to be a valid bps string".format(bps_str))
 
 
-def parse_bytes_retrans(words):
-    return int(find_tcp_value("bytes_retrans:", words, "0"))
-
-
-def parse_bytes_sent(words):
-    return int(find_tcp_value("bytes_sent:", words, "0"))
-
-
-def parse_rtt(words):
-    rtt, rttvar = find_tcp_value("rtt:", words, "NaN/NaN").split("/")
-    return float(rtt), float(rttvar)
-
-
-def parse_retrans(words):
-    retrans, retrans_total = find_tcp_value("retrans:", words, "0/0").split("/")
-    return int(retrans), int(retrans_total)
-
-
-def parse_delivery_rate(words):
-    return bps_str_to_numeric(find_tcp_value("delivery_rate", words, "0bps"))
-
-
 def plot_throughput_timeseries(flow_dfs, max_groups=0, stat_kwargs=None,
                                plot_retrans=True, legend=True, **kwargs):
     if "all" not in flow_dfs:
@@ -312,10 +514,14 @@ def main():
                         required=False)
     parser.add_argument("-g", "--guess-flows", help="guess which flows to include",
                         action="store_true", required=False)
+    parser.add_argument("-j", "--processes", type=int, default=1,
+                        help="number of processes to parse the log with (0 for one per CPU)",
+                        required=False)
     args = parser.parse_args()
 
     data = load_ss_tcp_data(args.input, dst=args.dst_filter,
-                            filter_main_flows=args.guess_flows)
+                            filter_main_flows=args.guess_flows,
+                            processes=args.processes if args.processes > 0 else None)
     fig = plot_ss_tcp_data(data)
 
     if args.output is not None:
@@ -2,6 +2,14 @@
 import numpy as np
 import pandas as pd
 import sys
+import re
+
+import util
+
+U32_MAX = 1 << 32
+
+# Netem time units in ms
+_netem_time_units = {"s": 1e3, "ms": 1, "us": 1e-3}
 
 def compute_base_delay(rtts, ms_offsets=[i * 10 for i in range(11)], next_consistent=10):
     """
@@ -15,10 +23,16 @@ def compute_base_delay(rtts, ms_offsets=[i * 10 for i in range(11)], next_consis
     
     start_idx = 0
     end_idx = 0
+    last_idx = len(rtts) - next_consistent
     for i in range(len(offsets) - 1):
-        while (end_idx+next_consistent < len(rtts) and 
-               any(rtts[end_idx:end_idx+next_consistent] < offsets[i+1])):
-            end_idx += 1
+        # Advance end_idx to the first window of next_consistent RTTs
+        # without any RTT below the next offset (or to the last window)
+        if end_idx < last_idx:
+            below = np.concatenate(([0], np.cumsum(rtts[end_idx:] < offsets[i+1])))
+            n_below = below[next_consistent:] - below[:len(below) - next_consistent]
+            consistent = n_below[:last_idx - end_idx] == 0
+            end_idx = (end_idx + np.argmax(consistent) if consistent.any()
+                       else last_idx)
         
         base_delay[start_idx:end_idx] = offsets[i]
         start_idx = end_idx
@@ -31,15 +45,92 @@ def compute_base_delay(rtts, ms_offsets=[i * 10 for i in range(11)], next_consis
     
     return base_delay
 
+def load_netem_schedule(filename):
+    """
+    Load the schedule of netem changes logged by run_tcp_accuracy_test.sh
+    (lines of "<unix timestamp> <add|change> <netem args>") into a DataFrame
+    with the timestamp and delay (in seconds) of each change, and whether it
+    is the setup of netem (add). Lines that cannot be parsed are skipped
+    with a warning, except for those with an unknown delay, which get a NaN
+    delay (as the previous delay no longer applies after them).
+    """
+    timestamps = []
+    delays = []
+    setups = []
+    with util.open_compressed_file(filename, mode="rt") as infile:
+        for line_nr, line in enumerate(infile, start=1):
+            words = line.split(maxsplit=2)
+            if len(words) < 1:
+                continue
+            if (len(words) < 2 or words[1] not in ("add", "change") or
+                    re.fullmatch(r"\d{1,10}(\.\d+)?", words[0]) is None):
+                print("Warning: Skipping unparsable line {} in {}: {}".format(
+                    line_nr, filename, line.rstrip()), file=sys.stderr)
+                continue
+
+            args = words[2] if len(words) > 2 else ""
+            match = re.search(r"\bdelay (\d+(?:\.\d+)?)(s|ms|us)\b", args)
+            if match is not None:
+                delay = float(match.group(1)) * _netem_time_units[match.group(2)]
+            elif re.search(r"\bdelay\b", args) is None:
+                delay = 0.0 # netem without delay
+            else:
+                print("Warning: Unknown delay on line {} in {}: {}".format(
+                    line_nr, filename, line.rstrip()), file=sys.stderr)
+                delay = np.nan
+            timestamps.append(words[0])
+            delays.append(delay)
+            setups.append(words[1] == "add")
+
+    schedule = pd.DataFrame({"timestamp": util.parse_unix_timestamps(timestamps),
+                             "delay": np.array(delays, dtype=float) * 1e-3,
+                             "setup": np.array(setups, dtype=bool)})
+    schedule = schedule.sort_values("timestamp", kind="stable").reset_index(drop=True)
+    if len(schedule) > 0 and not schedule["setup"].iloc[0]:
+        print("Warning: The netem setup is missing from {}, so the delay "
+              "before its first change is unknown".format(filename),
+              file=sys.stderr)
+    return schedule
+
+def compute_scheduled_base_delay(timestamps, rtts, schedule):
+    """
+    Base delay of each RTT from a netem schedule (see load_netem_schedule).
+    The delay is the one in effect when the acked packet was sent, ie. at
+    the timestamp minus the RTT. RTTs before the first change get the first
+    delay if it is the setup of netem (the capture starts after it, so they
+    can only be due to clock differences), otherwise NaN as their delay is
+    unknown. All RTTs get NaN if the schedule is empty.
+    """
+    timestamps = np.asarray(timestamps, dtype="datetime64[ns]")
+    rtts = np.nan_to_num(np.asarray(rtts, dtype=float))
+    sent = timestamps - (rtts * 1e9).astype("timedelta64[ns]")
+    if len(schedule) < 1:
+        return np.full(len(sent), np.nan)
+    
+    idx = np.searchsorted(schedule["timestamp"].values, sent, side="right") - 1
+    delays = schedule["delay"].values[np.clip(idx, 0, None)]
+    if not schedule["setup"].iloc[0]:
+        delays[idx < 0] = np.nan
+    return delays
+
 def add_delay_offset(rtt_dfs, ms_offsets=[i * 10 for i in range(11)], verify=True):
+    """
+    Add the base delay and the RTT above it. A base_delay column already in
+    a DataFrame (ex. from the netem schedule) is kept, otherwise it is
+    estimated from the RTTs with compute_base_delay, in which case it is
+    verified to be consistent among the tools if verify is True.
+    """
+    estimated = False
     for rtt_tool in rtt_dfs.keys():
         df = rtt_dfs[rtt_tool]
-        df["base_delay"] = compute_base_delay(df["rtt"], ms_offsets=ms_offsets)
+        if "base_delay" not in df.columns:
+            df["base_delay"] = compute_base_delay(df["rtt"], ms_offsets=ms_offsets)
+            estimated = True
         df["rtt_above"] = df["rtt"] - df["base_delay"]
         df["rtt_above_ms"] = df["rtt_above"] * 1e3
         df["rtt_above_us"] = df["rtt_above"] * 1e6
     
-    if verify:
+    if verify and estimated:
         verify_rtt_delays_consistent(rtt_dfs)
     
     return rtt_dfs
@@ -63,36 +154,90 @@ def verify_rtt_delays_consistent(rtt_dfs):
     
     return consistent
 
+def _pack_tsecr_ack(df):
+    """
+    Pack the TSecr and ACK of each RTT into a single uint64 key, or None if
+    they are not all integers within u32 (ex. if some are NaN).
+    """
+    keys = np.zeros(len(df), dtype=np.uint64)
+    for col in ["tsecr", "ack"]:
+        vals = df[col].values
+        if not (np.issubdtype(vals.dtype, np.integer) or
+                np.issubdtype(vals.dtype, np.floating)):
+            return None
+        if len(vals) > 0 and (not np.all(np.isfinite(vals)) or vals.min() < 0 or
+                              vals.max() >= U32_MAX or np.any(vals % 1 != 0)):
+            return None
+        keys = (keys << np.uint64(32)) | vals.astype(np.uint64)
+    return keys
+
+def _match_packed_keys(keys):
+    """
+    Indices into each of the key arrays of the keys found in all of them,
+    in the order they appear in the first one. Raises a MergeError if keys
+    are not unique (same as merging them with validate="1:1" would).
+    """
+    if len(keys) == 1:
+        return [np.arange(len(keys[0]))]
+    
+    sorted_keys = list()
+    for k in keys:
+        order = np.argsort(k, kind="stable")
+        if np.any(k[order][1:] == k[order][:-1]):
+            raise pd.errors.MergeError("Merge keys are not unique; not a one-to-one merge")
+        sorted_keys.append((order, k[order]))
+    
+    # Keys of the first array present in all the others
+    in_all = np.ones(len(keys[0]), dtype=bool)
+    for _, sk in sorted_keys[1:]:
+        in_all &= np.isin(keys[0], sk, assume_unique=True)
+    
+    common = keys[0][in_all]
+    return [np.flatnonzero(in_all)] + [order[np.searchsorted(sk, common)]
+                                       for order, sk in sorted_keys[1:]]
+
+def _match_merged_keys(dfs, merge_cols):
+    """Same as _match_packed_keys, but by chaining pandas merges on merge_cols"""
+    idx_cols = ["_idx{}".format(i) for i in range(len(dfs))]
+    merge_keys = dfs[0][merge_cols].assign(**{idx_cols[0]: np.arange(len(dfs[0]))})
+    for df, idx_col in zip(dfs[1:], idx_cols[1:]):
+        merge_keys = merge_keys.merge(df[merge_cols].assign(**{idx_col: np.arange(len(df))}),
+                                      on=merge_cols, how="inner", validate="1:1")
+    return [merge_keys[idx_col].values for idx_col in idx_cols]
+
 def filter_comparable_rtts(rtt_dfs):
+    """
+    Filter the RTTs of each tool to only those that all tools have (matched
+    on TSecr and ACK), in the order of the first tool. The position of each
+    RTT in the original DataFrame is added as a <tool>_idx column.
+    """
     merge_cols = ["tsecr", "ack"]
     filt = rtt_dfs.copy()
     get_idxkey = lambda x: "{}_idx".format(x)
     
-    # Get rid of duplicate TSecr and add idx to columns
     for rtt_tool in list(filt.keys()):
-        df = filt[rtt_tool].copy()
+        df = filt[rtt_tool]
         if not all([mc in df.columns for mc in merge_cols]):
             print("Warning: {} does not have the required columns {} - dropping it".format(
                 rtt_tool, merge_cols), file=sys.stderr)
             del filt[rtt_tool]
-            continue
-        
-        df[get_idxkey(rtt_tool)] = np.arange(len(df))
-        filt[rtt_tool] = df
     
-    # Find common RTTs (by merging on merge_cols)
+    # Find common RTTs, preferably by intersecting packed (tsecr, ack) keys
     rtt_tools = list(filt.keys())
-    merge_keys = filt[rtt_tools[0]][merge_cols + [get_idxkey(rtt_tools[0])]]
-    for rtt_tool in rtt_tools[1:]:
-        merge_keys = merge_keys.merge(filt[rtt_tool][merge_cols + [get_idxkey(rtt_tool)]], 
-                                      on=merge_cols, how="inner", validate="1:1")
+    keys = [_pack_tsecr_ack(filt[rtt_tool]) for rtt_tool in rtt_tools]
+    if len(keys) > 0 and all(k is not None for k in keys):
+        idxs = _match_packed_keys(keys)
+    else:
+        idxs = _match_merged_keys([filt[rtt_tool] for rtt_tool in rtt_tools],
+                                  merge_cols)
     
-    for rtt_tool in rtt_tools:
-        if len(merge_keys) < len(filt[rtt_tool]):
+    for rtt_tool, idx in zip(rtt_tools, idxs):
+        if len(idx) < len(filt[rtt_tool]):
             print("Warning: {} entries from {} missing in common set".format(
-                len(filt[rtt_tool]) - len(merge_keys), rtt_tool), file=sys.stderr)
+                len(filt[rtt_tool]) - len(idx), rtt_tool), file=sys.stderr)
         
-        idx = merge_keys[get_idxkey(rtt_tool)].values
-        filt[rtt_tool] = filt[rtt_tool].iloc[idx].reset_index(drop=True)
+        df = filt[rtt_tool].iloc[idx].reset_index(drop=True)
+        df[get_idxkey(rtt_tool)] = idx
+        filt[rtt_tool] = df
     
     return filt
@@ -3,9 +3,32 @@ import numpy as np
 import pandas as pd
 import gzip
 import lzma
+import io
+import os
+import mmap
+import shutil
 import subprocess
+import signal
 import re
 import decimal
+import contextlib
+import errno
+import fcntl
+import hashlib
+import tempfile
+import itertools
+import json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# External decompressors, which unlike the lzma module can decode
+# multi-block xz files (as created by xz -T0) in parallel
+_decompress_cmds = {"xz": ["xz", "-dcq", "-T0"],
+                    "zstd": ["zstd", "-dcq", "-T0"]}
 
 
 def guess_compression(filename):
@@ -13,20 +36,608 @@ def guess_compression(filename):
         return "gzip"
     elif str(filename).endswith(".xz"):
         return "xz"
+    elif str(filename).endswith(".zst"):
+        return "zstd"
     else:
         return "none"
 
 
-def open_compressed_file(filename, compression="auto", **kwargs):
-    open_funcs = {"none": open, "gzip": gzip.open, "xz": lzma.open}
+class _EOFTrackingPipe(io.RawIOBase):
+    """
+    Raw reader of a pipe, which records whether it has reached EOF.
+    """
+    def __init__(self, pipe):
+        self._pipe = pipe
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._pipe.readinto(b)
+        if n == 0 and len(b) > 0:
+            self.eof = True
+        return n
+
+    def fileno(self):
+        return self._pipe.fileno()
+
+    def close(self):
+        self._pipe.close()
+        super().close()
+
+
+class PipedFile:
+    """
+    File-like object reading the stdout of cmd + [filename]. Text mode (mode
+    containing "t") wraps the pipe in a TextIOWrapper, so it can be iterated
+    line by line just like a regular file. Raises a ChildProcessError on
+    close if the process failed, including if it was killed by a signal
+    (except by SIGPIPE when closing before reaching EOF).
+    """
+    def __init__(self, cmd, filename, mode="rb", encoding=None, errors=None,
+                 newline=None):
+        if "w" in mode or "a" in mode or "x" in mode:
+            raise ValueError("PipedFile only supports reading")
+
+        self.cmd = list(cmd) + [str(filename)]
+        # stderr goes to a file rather than a pipe, as a full stderr pipe
+        # would block the process while stdout is being read
+        self._stderr = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE,
+                                      stderr=self._stderr, bufsize=0)
+        self._pipe = _EOFTrackingPipe(self._proc.stdout)
+        self._file = io.BufferedReader(self._pipe)
+        if "t" in mode:
+            self._file = io.TextIOWrapper(self._file, encoding=encoding,
+                                          errors=errors, newline=newline)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._file.closed:
+            return
+        reached_eof = self._pipe.eof
+        self._file.close()
+
+        # Killed by SIGPIPE if closed before EOF, which is fine, but any
+        # other failure (or signal) means the output may be truncated
+        returncode = self._proc.wait()
+        self._stderr.seek(0)
+        stderr = self._stderr.read()
+        self._stderr.close()
+        if returncode != 0 and (reached_eof or
+                                returncode != -signal.SIGPIPE):
+            if returncode < 0:
+                reason = "killed by {}".format(
+                    signal.Signals(-returncode).name)
+            else:
+                reason = "exit status {}".format(returncode)
+            raise ChildProcessError("{} failed ({}): {}".format(
+                " ".join(self.cmd), reason, stderr.decode(errors="replace")))
+
+
+def _open_zstd(filename, mode="rb", **kwargs):
+    if zstandard is None:
+        raise RuntimeError("Reading zstd files requires either the zstd "
+                           "binary or the zstandard module")
+    return zstandard.open(filename, mode=mode, **kwargs)
+
+
+def open_compressed_file(filename, compression="auto", external=True,
+                         **kwargs):
+    """
+    Open a (possibly) compressed file for reading. If external is True and
+    the xz/zstd binaries are available, the file is decompressed by piping
+    it through them (multi-threaded), otherwise the python modules are used.
+    """
+    open_funcs = {"none": open, "gzip": gzip.open, "xz": lzma.open,
+                  "zstd": _open_zstd}
     if compression == "auto":
         compression = guess_compression(filename)
 
+    if (external and compression in _decompress_cmds and
+            shutil.which(_decompress_cmds[compression][0]) is not None):
+        return PipedFile(_decompress_cmds[compression], filename, **kwargs)
+
     return open_funcs[compression](filename, **kwargs)
 
 
+def _split_lines(text):
+    """Split text into lines, keeping the trailing newlines like readlines()"""
+    # str.splitlines is faster, but also splits on other (ASCII) line breaks
+    if text.isascii() and not any(char in text
+                                  for char in "\r\x0b\x0c\x1c\x1d\x1e"):
+        return text.splitlines(keepends=True)
+
+    lines = text.split("\n")
+    last = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if len(last) > 0:
+        lines.append(last)
+    return lines
+
+
+class LineIndexedFile:
+    """
+    Random access to the lines of a text file through an index of the byte
+    offset where each line starts. Uncompressed files are memory-mapped, so
+    the raw bytes of (ranges of) lines can be accessed without copying them.
+    Compressed files are decompressed into memory.
+
+    Lines are returned including their trailing newline, like readlines().
+    """
+    def __init__(self, filename, compression="auto", encoding="utf-8",
+                 block_size=1 << 26):
+        if compression == "auto":
+            compression = guess_compression(filename)
+        self.encoding = encoding
+        self._mmap = None
+
+        if compression == "none":
+            with open(filename, "rb") as file:
+                if os.fstat(file.fileno()).st_size > 0:
+                    self._mmap = mmap.mmap(file.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+            data = self._mmap if self._mmap is not None else b""
+        else:
+            with open_compressed_file(filename, compression, mode="rb") as file:
+                data = file.read()
+
+        self._data = memoryview(data)
+        self.offsets = self._index_lines(block_size)
+
+    def _index_lines(self, block_size):
+        buf = np.frombuffer(self._data, dtype=np.uint8)
+        ends = [np.flatnonzero(buf[i:i+block_size] == ord("\n")) + i + 1
+                for i in range(0, len(buf), block_size)]
+        offsets = np.concatenate([np.zeros(1, dtype=np.int64)] + ends)
+        if offsets[-1] != len(buf):
+            offsets = np.append(offsets, len(buf))
+        return offsets.astype(np.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            lines = self.lines(start, stop)
+            return lines[::step]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("line index out of range")
+        return self.raw(idx, idx + 1).tobytes().decode(self.encoding)
+
+    def __iter__(self):
+        for _, lines in self.iter_chunks():
+            yield from lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def raw(self, start=0, stop=None):
+        """
+        Zero-copy memoryview of the bytes of lines [start, stop). Release it
+        before closing the file.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        start = min(start, stop)
+        return self._data[self.offsets[start]:self.offsets[stop]]
+
+    def lines(self, start=0, stop=None):
+        """Decoded lines [start, stop)"""
+        with self.raw(start, stop) as raw:
+            return _split_lines(str(raw, self.encoding))
+
+    def iter_chunks(self, chunk_lines=1 << 16):
+        """Yield (first line number, lines) for chunks of chunk_lines lines"""
+        for start in range(0, len(self), chunk_lines):
+            yield start, self.lines(start, start + chunk_lines)
+
+    def close(self):
+        self._data.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+def open_lines(filename, compression="auto"):
+    """
+    Open a text file for reading in chunks of lines (see iter_text_chunks).
+    Uncompressed files are opened as a LineIndexedFile, compressed ones are
+    streamed in text mode. Parsers that go line by line are better off with
+    open_compressed_file, as iterating a LineIndexedFile has to index and
+    split the lines first.
+    """
+    if compression == "auto":
+        compression = guess_compression(filename)
+    if compression == "none":
+        return LineIndexedFile(filename, compression)
+    return open_compressed_file(filename, compression, mode="rt")
+
+
+def iter_line_chunks(file, chunk_lines=1 << 16):
+    """
+    Yield lists of (at most) chunk_lines lines from a file opened with
+    open_lines (or any other iterable of lines).
+    """
+    if isinstance(file, LineIndexedFile):
+        for _, lines in file.iter_chunks(chunk_lines):
+            yield lines
+        return
+
+    lines = iter(file)
+    while True:
+        chunk = list(itertools.islice(lines, chunk_lines))
+        if len(chunk) < 1:
+            return
+        yield chunk
+
+
+def iter_text_chunks(file, chunk_lines=1 << 16):
+    """
+    Like iter_line_chunks, but yield each chunk of lines as a single string,
+    which for a LineIndexedFile is decoded without splitting it into lines.
+    """
+    if isinstance(file, LineIndexedFile):
+        for start in range(0, len(file), chunk_lines):
+            with file.raw(start, start + chunk_lines) as raw:
+                yield str(raw, file.encoding)
+        return
+
+    for lines in iter_line_chunks(file, chunk_lines):
+        yield "".join(lines)
+
+
 def xz_decompress_file(filename):
-    subprocess.run(["xz", "-dk", filename], check=True)
+    subprocess.run(["xz", "-dk", "-T0", filename], check=True)
+
+
+def _default_cache_dir():
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(base, "pping-decompression-cache")
+
+
+def _default_fallback_dir():
+    return "/var/tmp" if os.path.isdir("/var/tmp") else tempfile.gettempdir()
+
+
+DECOMPRESSION_CACHE_DIR = os.environ.get("DECOMPRESSION_CACHE_DIR",
+                                         _default_cache_dir())
+# Unless set, the cache is limited to 8 GiB or half of its file system
+# (which by default is in RAM), whichever is smaller
+DECOMPRESSION_CACHE_MAX_SIZE = os.environ.get("DECOMPRESSION_CACHE_MAX_SIZE")
+if DECOMPRESSION_CACHE_MAX_SIZE is not None:
+    DECOMPRESSION_CACHE_MAX_SIZE = int(DECOMPRESSION_CACHE_MAX_SIZE)
+# Where files that do not fit in the cache are decompressed instead
+DECOMPRESSION_FALLBACK_DIR = os.environ.get("DECOMPRESSION_FALLBACK_DIR",
+                                            _default_fallback_dir())
+
+_content_hashes = dict()
+
+
+def file_content_hash(filename, chunk_size=1 << 24):
+    """
+    Hash of the content of filename. Memoized on path, size and mtime, so
+    the file is only read once per process unless it changes.
+    """
+    stat = os.stat(filename)
+    key = (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+    if key not in _content_hashes:
+        digest = hashlib.blake2b(digest_size=20)
+        with open(filename, "rb") as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                digest.update(chunk)
+        _content_hashes[key] = digest.hexdigest()
+    return _content_hashes[key]
+
+
+def _decompressed_size(filename, compression):
+    """
+    Size of the decompressed content of filename according to its headers,
+    or None if it can not be determined cheaply.
+    """
+    try:
+        if compression == "xz":
+            p = subprocess.run(["xz", "--robot", "--list", str(filename)],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               text=True)
+            for line in p.stdout.split("\n"):
+                fields = line.split("\t")
+                if p.returncode == 0 and fields[0] == "totals":
+                    return int(fields[4])
+        elif compression == "gzip":
+            # ISIZE, the size modulo 2^32, in the last 4 bytes
+            with open(filename, "rb") as infile:
+                infile.seek(-4, os.SEEK_END)
+                return int.from_bytes(infile.read(4), "little")
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class DecompressionCache:
+    """
+    Shared cache of decompressed files, safe to use from concurrent
+    processes. Entries are named after the hash of the compressed content.
+    Each entry has a lock file which users hold a shared lock on, so an
+    entry is only evicted (least recently used first, once the total size
+    exceeds max_size or the file system is full) when no process is using
+    it. Files that do not fit in the cache even after evicting the unused
+    entries are decompressed to a private file in fallback_dir instead.
+    """
+    def __init__(self, cache_dir=None, max_size=None, fallback_dir=None):
+        self.cache_dir = DECOMPRESSION_CACHE_DIR if cache_dir is None else cache_dir
+        self.max_size = (DECOMPRESSION_CACHE_MAX_SIZE if max_size is None
+                         else max_size)
+        self.fallback_dir = (DECOMPRESSION_FALLBACK_DIR if fallback_dir is None
+                             else fallback_dir)
+
+    def _entry_path(self, filename, compression):
+        name = os.path.basename(str(filename))
+        if compression != "none":
+            name = os.path.splitext(name)[0]
+        return os.path.join(self.cache_dir, "{}-{}".format(
+            file_content_hash(filename), name))
+
+    @contextlib.contextmanager
+    def decompressed(self, filename, compression="auto"):
+        """
+        Context manager giving the path to a decompressed copy of filename,
+        which stays valid until the context is exited. Uncompressed files
+        are passed through as is.
+        """
+        if compression == "auto":
+            compression = guess_compression(filename)
+        if compression == "none":
+            yield str(filename)
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._entry_path(filename, compression)
+        with open(path + ".lock", "a") as lock:
+            cached = self._acquire(lock, filename, compression, path)
+            if cached:
+                try:
+                    yield path
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            else:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        if cached:
+            self.evict()
+            return
+
+        os.makedirs(self.fallback_dir, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix="pping-decompressed-",
+                                         dir=self.fallback_dir) as tmpdir:
+            tmp_path = os.path.join(tmpdir, os.path.basename(path))
+            self._decompress(filename, compression, tmp_path)
+            yield tmp_path
+
+    def _acquire(self, lock, filename, compression, path):
+        """
+        Lock the entry for filename (decompressing it if needed). Returns
+        False if it does not fit in the cache (with the lock held).
+        """
+        while True:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            if os.path.exists(path):
+                os.utime(path)
+                return True
+
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(path):
+                # Make room before decompressing, so the file system is not
+                # filled up with unused entries
+                size = _decompressed_size(filename, compression)
+                if not self.evict(0 if size is None else size):
+                    return False
+                try:
+                    self._decompress(filename, compression, path)
+                except OSError as err:
+                    if err.errno != errno.ENOSPC:
+                        raise
+                    return False
+                self.evict()
+            # Downgrading the lock is not atomic, so recheck the entry exists
+
+    def _decompress(self, filename, compression, path):
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        try:
+            with open_compressed_file(filename, compression, mode="rb") as infile, \
+                 open(tmp_path, "wb") as outfile:
+                shutil.copyfileobj(infile, outfile, 1 << 24)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _size_limit(self, total_size):
+        """
+        Size limit of the cache: max_size (by default at most half of the
+        file system), but never more than fits on the file system.
+        """
+        stat = os.statvfs(self.cache_dir)
+        capacity = total_size + stat.f_bavail * stat.f_frsize
+        max_size = self.max_size
+        if max_size is None:
+            max_size = min(8 << 30, stat.f_blocks * stat.f_frsize // 2)
+        return min(max_size, capacity)
+
+    def evict(self, needed=0):
+        """
+        Remove unused entries, least recently used first, until there is
+        room for needed more bytes within the size limit. Returns False if
+        there is not.
+        """
+        entries = list()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".lock") or ".tmp" in name:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(entry[1] for entry in entries)
+        size_limit = self._size_limit(total_size)
+        if needed > size_limit:
+            return False  # Would not fit even if everything was evicted
+
+        for _, size, path in sorted(entries):
+            if total_size + needed <= size_limit:
+                break
+            with open(path + ".lock", "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # In use
+                if os.path.exists(path):
+                    os.remove(path)
+                    total_size -= size
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        return total_size + needed <= size_limit
+
+
+def decompressed_file(filename, compression="auto", cache=None):
+    """
+    Context manager giving the path to a decompressed copy of filename from
+    the shared DecompressionCache (or cache if given).
+    """
+    if cache is None:
+        cache = DecompressionCache()
+    return cache.decompressed(filename, compression)
+
+
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", os.path.join(
+    os.path.expanduser("~"), ".cache", "pping-result-cache"))
+RESULT_CACHE_MAX_SIZE = int(os.environ.get("RESULT_CACHE_MAX_SIZE", 4 << 30))
+
+
+def source_hash(*modules):
+    """
+    Combined hash of the source files of modules, to make cached results
+    depend on (the current version of) the code producing them.
+    """
+    return "-".join(file_content_hash(module.__file__) for module in modules)
+
+
+def program_identity(program):
+    """
+    Resolved path, size and mtime of an external program (looked up in PATH
+    if needed), to make cached results depend on the version of it.
+    """
+    path = shutil.which(os.path.expanduser(program))
+    if path is None:
+        return program
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+class ResultCache:
+    """
+    On-disk cache of results (typically DataFrames) computed from a file.
+    Entries are keyed on a name, the content hash of the file and any
+    further params the result depends on (arguments, program_identity of
+    external tools, source_hash of the modules producing it, etc.), so a
+    changed input gives a new entry instead of a stale result. Entries are
+    pickled, which keeps the exact dtypes. Once the entries exceed max_size
+    the least recently used ones are removed. Entries can also safely be
+    removed by hand at any time (ex. by clear()).
+    """
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = RESULT_CACHE_DIR if cache_dir is None else cache_dir
+        self.max_size = RESULT_CACHE_MAX_SIZE if max_size is None else max_size
+
+    def entry_path(self, name, filename, **params):
+        key = json.dumps([name, file_content_hash(filename), params],
+                         sort_keys=True, default=str)
+        digest = hashlib.blake2b(key.encode(), digest_size=20).hexdigest()
+        return os.path.join(self.cache_dir, "{}-{}.pkl".format(name, digest))
+
+    def load(self, path):
+        result = pd.read_pickle(path)
+        os.utime(path)
+        return result
+
+    def store(self, path, result):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        try:
+            pd.to_pickle(result, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def _entries(self):
+        entries = list()
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".pkl"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """Remove entries, least recently used first, until within max_size"""
+        entries = self._entries()
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        """Remove all entries"""
+        if os.path.isdir(self.cache_dir):
+            for _, _, path in self._entries():
+                os.remove(path)
+
+    def get(self, name, filename, compute, **params):
+        """
+        Load the cached result for filename, or store the result of
+        compute() if there is none.
+        """
+        path = self.entry_path(name, filename, **params)
+        try:
+            return self.load(path)
+        except FileNotFoundError:
+            pass
+
+        result = compute()
+        self.store(path, result)
+        return result
 
 
 def normalize_timestamps(timestamps, reference=None):
@@ -112,3 +723,40 @@ def parse_unix_timestamp(somestr):
     """
     ns = int(decimal.Decimal(somestr) * 1000000000)
     return np.datetime64("1970-01-01T00:00") + np.timedelta64(ns, "ns")
+
+
+_POW10 = 10 ** np.arange(19, dtype=np.int64)
+
+
+def parse_unix_timestamps(strings):
+    """
+    Vectorized version of parse_unix_timestamp for an array of unix
+    timestamps strings in the format sec[.frac]. Gives identical results
+    (fractions beyond ns are truncated), but works directly on the bytes of
+    the strings instead of creating a Decimal for each timestamp.
+    """
+    chars = np.asarray(strings, dtype="S").reshape(-1)
+    if len(chars) == 0:
+        return np.array([], dtype="datetime64[ns]")
+
+    b = chars.view(np.uint8).reshape(len(chars), chars.itemsize)
+    is_dot = b == ord(".")
+    is_digit = (b >= ord("0")) & (b <= ord("9"))
+    n_digits = np.count_nonzero(is_digit, axis=1)
+    dot = np.where(is_dot.any(axis=1), np.argmax(is_dot, axis=1),
+                   np.count_nonzero(b, axis=1))
+
+    if (not np.all(is_digit | is_dot | (b == 0)) or
+            np.any(np.count_nonzero(is_dot, axis=1) > 1) or
+            np.any(n_digits == 0) or np.any(dot > 10)):
+        raise ValueError("Not all strings are valid unix timestamps")
+
+    # Add up each digit's contribution in ns, one character position at a time
+    ns = np.zeros(len(chars), dtype=np.int64)
+    for i in range(min(b.shape[1], dot.max() + 10)):
+        exp = np.where(i < dot, 8 + dot - i, 9 + dot - i)
+        valid = is_digit[:, i] & (exp >= 0)
+        ns += np.where(valid, (b[:, i].astype(np.int64) - ord("0")) *
+                       _POW10[np.clip(exp, 0, 18)], 0)
+
+    return ns.astype("datetime64[ns]")